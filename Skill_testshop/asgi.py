@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Skill_testshop.settings')
 
 application = get_asgi_application()
+
+from goods.cache import warm_category_cache  # noqa: E402 apps must be loaded first
+
+warm_category_cache()
@@ -97,14 +97,60 @@ DATABASES = {
         'PASSWORD': env.str('DB_PASSWORD'),
         'HOST': env.str('DB_HOST'),
         'PORT': env.str('DB_PORT'),
+        # a file on sqlite as well: the concurrency tests need a database which threads can share
+        'TEST': {'NAME': env.str('DB_TEST_NAME', default=os.path.join(os.path.dirname(env.str('DB_NAME')),
+                                                                     'test_' + os.path.basename(env.str('DB_NAME'))))},
     }
 }
 
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+# seconds to keep a cached catalog page, and to wait for a page being built by another request
+CATALOG_CACHE_TIMEOUT = env.int('CATALOG_CACHE_TIMEOUT', default=300)
+CATALOG_CACHE_WAIT = env.int('CATALOG_CACHE_WAIT', default=5)
+
+# maximum number of products requested by /api/products/batch/
+PRODUCT_BATCH_MAX_SIZE = env.int('PRODUCT_BATCH_MAX_SIZE', default=100)
+
+# csv rows read, validated and written by the importer at a time
+IMPORT_BATCH_SIZE = env.int('IMPORT_BATCH_SIZE', default=1000)
+# write a batch with one INSERT ... ON CONFLICT statement (postgresql and sqlite),
+# otherwise with bulk_create for new articles and bulk_update for existing ones
+IMPORT_UPSERT = env.bool('IMPORT_UPSERT', default=True)
+# worker processes parsing and validating the import file, 0 or 1 to do it in the importing process,
+# and the size of a part of the file given to a worker at a time
+IMPORT_WORKERS = env.int('IMPORT_WORKERS', default=0)
+IMPORT_CHUNK_BYTES = env.int('IMPORT_CHUNK_BYTES', default=4 * 1024 * 1024)
+# file mirroring the import logs, empty to keep them only on the imports,
+# and the number of log entries kept on an import
+IMPORT_LOG_FILE = env.str('IMPORT_LOG_FILE', default='import_log.txt')
+IMPORT_LOG_MAX_ENTRIES = env.int('IMPORT_LOG_MAX_ENTRIES', default=1000)
+# seconds an import in progress may go without saving a batch before it is queued again
+IMPORT_STALE_TIMEOUT = env.int('IMPORT_STALE_TIMEOUT', default=10 * 60)
+
+# seconds a product added to a cart is held for it, expired holds are deleted by release_reservations
+CART_RESERVATION_TTL = env.int('CART_RESERVATION_TTL', default=15 * 60)
+
+# seconds the response of a checkout is replayed to the retries with its idempotency key,
+# older keys are deleted by purge_checkout_keys
+CHECKOUT_KEY_TTL = env.int('CHECKOUT_KEY_TTL', default=24 * 60 * 60)
+
+# products per storefront page
+INDEX_PAGE_SIZE = env.int('INDEX_PAGE_SIZE', default=24)
+
+# rows fetched from the database per round-trip by the catalog export
+EXPORT_CHUNK_SIZE = env.int('EXPORT_CHUNK_SIZE', default=2000)
+
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 8
 }
 
+# 'goods.search.TokenSearchFilter' or 'rest_framework.filters.SearchFilter'
+PRODUCT_SEARCH_BACKEND = env.str('PRODUCT_SEARCH_BACKEND', default='goods.search.TokenSearchFilter')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
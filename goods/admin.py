@@ -1,14 +1,36 @@
 from django.contrib import admin
 
-from goods.models import Product, Category
+from goods.models import Product, Category, ProductImportFile
+from goods.stock import distribute_stock
 
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('id', 'title', 'article', 'price', 'quantity')
+    list_display = ('id', 'title', 'article', 'price', 'total_quantity', 'stock_shards')
     change_list_template = 'admin/product_change_list.html'
 
+    def get_object(self, request, object_id, from_field=None):
+        # the form edits the whole stock, also of a product with stock shards
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None:
+            obj.quantity = obj.total_quantity
+        return obj
+
+    def save_model(self, request, obj, form, change) -> None:
+        super().save_model(request, obj, form, change)
+        if obj.stock_shards or change:
+            distribute_stock([obj.pk])
+
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     list_display = ('id', 'name')
+
+
+@admin.register(ProductImportFile)
+class ProductImportFileAdmin(admin.ModelAdmin):
+    list_display = ('id', 'file', 'status', 'dry_run', 'rows_processed', 'rows_total', 'errors', 'warnings',
+                    'created_at')
+    list_filter = ('status', )
+    readonly_fields = ('status', 'rows_processed', 'rows_total', 'rows_created', 'rows_updated', 'rows_unchanged',
+                       'errors', 'warnings', 'file_hash', 'log_info', 'log_entries')
@@ -1,28 +1,143 @@
+import hashlib
+from datetime import datetime
+from typing import List, Optional, Tuple
+from urllib.parse import urlencode
+
+from django.conf import settings
 from django.db.models import QuerySet
-from rest_framework import filters
+from django.http import HttpRequest, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.utils.module_loading import import_string
+from django.views.decorators.http import condition
 from rest_framework import mixins
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
+from goods.cache import get_catalog_modified, get_catalog_version, get_or_build
 from goods.exceptions import WrongQueryParams
-from goods.serializers import ProductSerializer
-from goods.services import get_products
+from goods.pagination import get_pagination_class
+from goods.serializers import FastProductSerializer
+from goods.services import export_products, get_products, gzip_stream
+
+
+ALLOW_PARAMS = ['category_id', 'category', 'search', 'offset', 'limit', 'cursor', 'pagination']
+EXPORT_PARAMS = ['category_id', 'category', 'output', 'gzip']
+EXPORT_CONTENT_TYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+BATCH_KEYS = {'ids': 'id', 'articles': 'article'}
+
+
+def get_params_hash(request: HttpRequest) -> str:
+    """
+    Hash of the list parameters. Pagination links of the list are absolute, so the scheme and host are included
+    """
+    params = urlencode(sorted((key, value) for key in ALLOW_PARAMS
+                              for value in request.GET.getlist(key)))
+    return hashlib.md5(f'{request.build_absolute_uri("/")}?{params}'.encode()).hexdigest()
 
 
-ALLOW_PARAMS = ['category_id', 'category', 'search', 'offset', 'limit']
+def products_etag(request: HttpRequest, *args, **kwargs) -> str:
+    accept = hashlib.md5(request.META.get('HTTP_ACCEPT', '').encode()).hexdigest()
+    return f'{get_catalog_version()}-{get_params_hash(request)}-{accept}'
+
+
+def catalog_last_modified(request: HttpRequest, *args, **kwargs) -> Optional[datetime]:
+    return get_catalog_modified()
 
 
 class ProductViewSet(mixins.ListModelMixin, GenericViewSet):
-    serializer_class = ProductSerializer
-    filter_backends = [filters.SearchFilter]
+    serializer_class = FastProductSerializer
+    filter_backends = [import_string(settings.PRODUCT_SEARCH_BACKEND)]
     search_fields = ['title']
 
-    def get_queryset(self) -> QuerySet:
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            self._paginator = get_pagination_class(self.request.query_params)()
+        return self._paginator
+
+    def check_query_params(self, allow_params: list = ALLOW_PARAMS) -> None:
         wrong_params = [x for x in self.request.query_params.keys()
-                        if x not in ALLOW_PARAMS]
+                        if x not in allow_params]
         category_name = self.request.query_params.get('category')
         category_id = self.request.query_params.get('category_id')
         if wrong_params or all([category_name, category_id]):
             raise WrongQueryParams
 
-        queryset = get_products(category_id=category_id, category_name=category_name)
+    def get_queryset(self) -> QuerySet:
+        self.check_query_params()
+        queryset = get_products(category_id=self.request.query_params.get('category_id'),
+                                category_name=self.request.query_params.get('category'))
         return queryset
+
+    def filter_queryset(self, queryset: QuerySet) -> QuerySet:
+        return self.get_serializer_queryset(super().filter_queryset(queryset))
+
+    def get_serializer_queryset(self, queryset: QuerySet) -> QuerySet:
+        value_fields = getattr(self.get_serializer_class(), 'value_fields', None)
+        if value_fields:
+            queryset = queryset.values(*value_fields)
+        return queryset
+
+    def get_cache_key(self) -> str:
+        return f'products:{get_catalog_version()}:{get_params_hash(self.request)}'
+
+    @method_decorator(condition(etag_func=products_etag, last_modified_func=catalog_last_modified))
+    def list(self, request: Request, *args, **kwargs) -> Response:
+        self.check_query_params()
+        data = get_or_build(self.get_cache_key(), lambda: super(ProductViewSet, self).list(request).data)
+        return Response(data)
+
+    @action(detail=False)
+    def export(self, request: Request) -> StreamingHttpResponse:
+        """
+        Whole catalog as csv (`output=csv`, default) or NDJSON (`output=ndjson`), optionally gzipped (`gzip=1`)
+        """
+        self.check_query_params(EXPORT_PARAMS)
+        output = request.query_params.get('output', 'csv')
+        if output not in EXPORT_CONTENT_TYPES:
+            raise WrongQueryParams
+        products = get_products(category_id=request.query_params.get('category_id'),
+                                category_name=request.query_params.get('category'))
+        stream = export_products(products, output, chunk_size=settings.EXPORT_CHUNK_SIZE)
+        filename = f'products.{output}'
+        content_type = EXPORT_CONTENT_TYPES[output]
+        if request.query_params.get('gzip') in ('1', 'true'):
+            stream = gzip_stream(stream)
+            filename += '.gz'
+            content_type = 'application/gzip'
+        response = StreamingHttpResponse(stream, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    def get_batch_keys(self) -> Tuple[str, List]:
+        data = self.request.data if self.request.method == 'POST' else {
+            param: self.request.query_params[param].split(',')
+            for param in self.request.query_params if param in BATCH_KEYS
+        }
+        params = [param for param in BATCH_KEYS if param in data]
+        if len(params) != 1:
+            raise ValidationError('Specify either ids or articles.')
+        keys = data[params[0]]
+        if not isinstance(keys, list) or not 0 < len(keys) <= settings.PRODUCT_BATCH_MAX_SIZE:
+            raise ValidationError(f'Specify from 1 to {settings.PRODUCT_BATCH_MAX_SIZE} {params[0]}.')
+        try:
+            keys = [int(key) if params[0] == 'ids' else str(key) for key in keys]
+        except (TypeError, ValueError):
+            raise ValidationError('Product ids must be integers.')
+        return BATCH_KEYS[params[0]], list(dict.fromkeys(keys))
+
+    @action(detail=False, methods=['get', 'post'])
+    def batch(self, request: Request) -> Response:
+        """
+        Products by a list of ids (`ids`) or articles (`articles`) in one query,
+        as a comma separated query parameter or a json list in the request body
+        """
+        field, keys = self.get_batch_keys()
+        products = get_products().filter(**{f'{field}__in': keys})
+        found = {item[field]: item
+                 for item in self.get_serializer(self.get_serializer_queryset(products), many=True).data}
+        return Response({'results': [found[key] for key in keys if key in found],
+                         'missing': [key for key in keys if key not in found]})
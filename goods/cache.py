@@ -0,0 +1,158 @@
+import logging
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
+from django.http import Http404
+from django.utils import timezone
+
+from goods.models import Category
+
+logger = logging.getLogger(__name__)
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_MODIFIED_KEY = 'catalog:modified'
+CATEGORIES_VERSION_KEY = 'categories:version'
+PRICES_VERSION_KEY = 'prices:version'
+
+
+def _get_version(key: str) -> int:
+    version = cache.get(key)
+    if version is None:
+        # start from the current time so that versions are not reused after a cache flush
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _incr_version(key: str) -> None:
+    try:
+        cache.incr(key)
+    except ValueError:
+        _get_version(key)
+
+
+def get_catalog_version() -> int:
+    """
+    Current catalog version, part of the key of every cached catalog page
+    """
+    return _get_version(CATALOG_VERSION_KEY)
+
+
+def get_catalog_modified() -> Optional[datetime]:
+    """
+    Time of the last catalog change. Unknown after a cache flush, so it restarts from the current time.
+    Last-Modified has a one second precision: while the change falls in the current second
+    another change may follow within the same second, so None is returned and only the ETag is used.
+    """
+    modified = cache.get(CATALOG_MODIFIED_KEY)
+    if modified is None:
+        cache.add(CATALOG_MODIFIED_KEY, timezone.now(), timeout=None)
+        modified = cache.get(CATALOG_MODIFIED_KEY)
+    if modified >= timezone.now().replace(microsecond=0):
+        return None
+    return modified
+
+
+def _incr_catalog_version() -> None:
+    _incr_version(CATALOG_VERSION_KEY)
+    cache.set(CATALOG_MODIFIED_KEY, timezone.now(), timeout=None)
+
+
+def bump_catalog_version() -> None:
+    """
+    Invalidate all cached catalog pages once the current transaction is committed,
+    so that a page built before the commit is not cached under the new version
+    """
+    transaction.on_commit(_incr_catalog_version)
+
+
+def get_prices_version() -> int:
+    """
+    Version of the product prices, the cart summaries computed under another version are recomputed
+    """
+    return _get_version(PRICES_VERSION_KEY)
+
+
+def bump_prices_version() -> None:
+    """
+    Invalidate the cart summaries once the current transaction is committed. Stock changes don't call it.
+    """
+    transaction.on_commit(lambda: _incr_version(PRICES_VERSION_KEY))
+
+
+def get_or_build(key: str, build: Callable[[], Any], timeout: int = None) -> Any:
+    """
+    Get value from cache or build it. Only one caller builds a missing value,
+    the others wait for it until CATALOG_CACHE_WAIT seconds pass and then build it themselves.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+    timeout = timeout or settings.CATALOG_CACHE_TIMEOUT
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, 1, timeout=settings.CATALOG_CACHE_WAIT):
+        try:
+            value = build()
+            cache.set(key, value, timeout=timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+    deadline = time.monotonic() + settings.CATALOG_CACHE_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        value = cache.get(key)
+        if value is not None:
+            return value
+    return build()
+
+
+class CategoryMap:
+    """
+    Process-local id <-> name map of all categories. It is reloaded with one query
+    when another process changes categories and bumps the shared categories version.
+    """
+
+    def __init__(self) -> None:
+        self.version = None
+        self.by_id: Dict[int, str] = {}
+        self.by_name: Dict[str, int] = {}
+
+    def load(self) -> None:
+        version = _get_version(CATEGORIES_VERSION_KEY)
+        categories = dict(Category.objects.values_list('id', 'name'))
+        self.by_id, self.by_name = categories, {name: pk for pk, name in categories.items()}
+        self.version = version
+
+    def get_id(self, category_id: Any = None, name: Optional[str] = None) -> int:
+        """
+        Id of the category given by id or name, Http404 for unknown categories
+        """
+        if self.version != _get_version(CATEGORIES_VERSION_KEY):
+            self.load()
+        try:
+            category_id = int(category_id) if category_id is not None else self.by_name[name]
+        except (KeyError, ValueError):
+            raise Http404('No Category matches the given query.')
+        if category_id not in self.by_id:
+            raise Http404('No Category matches the given query.')
+        return category_id
+
+    def invalidate(self) -> None:
+        """
+        Reload categories in all processes once the current transaction is committed
+        """
+        transaction.on_commit(lambda: _incr_version(CATEGORIES_VERSION_KEY))
+
+
+categories = CategoryMap()
+
+
+def warm_category_cache() -> None:
+    try:
+        categories.load()
+    except DatabaseError:
+        logger.exception('Categories were not loaded')
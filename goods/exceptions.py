@@ -4,7 +4,8 @@ from rest_framework.exceptions import APIException
 class WrongQueryParams(APIException):
     status_code = 405
     default_detail = 'Wrong filter parameters or not specified category_id. ' \
-                     'You need to use only next parameters: category_id or category, search.'
+                     'You need to use only next parameters: category_id or category, search, ' \
+                     'offset and limit or pagination=cursor and cursor.'
     default_code = 'WrongQueryParams'
 
 
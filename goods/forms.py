@@ -5,12 +5,12 @@ from goods.models import ProductImportFile
 
 
 class ImportForm(forms.ModelForm):
-    file = forms.FileField(label='Your csv file', required=True,
+    file = forms.FileField(label='Your csv or ndjson file, may be compressed', required=True,
                            widget=FileInput(attrs={
                                'class': 'import_row',
-                               'accept': '.csv',
+                               'accept': '.csv,.ndjson,.jsonl,.gz,.bz2,.xz,.zst',
                                }))
 
     class Meta:
         model = ProductImportFile
-        fields = ['file', ]
+        fields = ['file', 'dry_run']
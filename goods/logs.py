@@ -0,0 +1,72 @@
+import atexit
+import logging
+import queue
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Iterable, List, Sequence
+
+
+def import_extra(import_id: int, articles: Iterable = ()) -> Dict:
+    """
+    `extra` of an import log record: the import it belongs to and the affected articles
+    """
+    return {'import_id': import_id, 'articles': list(articles)}
+
+
+def format_articles(articles: Sequence, limit: int = 10) -> str:
+    """
+    Articles for a log message, the ones beyond `limit` are only counted, all of them go to `import_extra`
+    """
+    shown = ', '.join(str(article) for article in articles[:limit])
+    if len(articles) > limit:
+        shown += f', ... {len(articles) - limit} more'
+    return f'({shown})'
+
+
+class ImportLogCollector(logging.Handler):
+    """
+    Keeps the records of one import as structured entries. The buffer is bounded:
+    the oldest entries and the articles beyond `max_articles` of an entry are dropped, only counted.
+    """
+
+    def __init__(self, import_id: int, max_entries: int = 1000, max_articles: int = 100) -> None:
+        super().__init__()
+        self.import_id = import_id
+        self.max_articles = max_articles
+        self.entries = deque(maxlen=max_entries)
+        self.dropped = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if getattr(record, 'import_id', None) != self.import_id:
+            return
+        if len(self.entries) == self.entries.maxlen:
+            self.dropped += 1
+        articles = getattr(record, 'articles', [])
+        self.entries.append({'level': record.levelname,
+                             'message': record.getMessage(),
+                             'count': len(articles),
+                             'articles': articles[:self.max_articles]})
+
+    def get_entries(self) -> List[Dict]:
+        return list(self.entries)
+
+    def get_text(self) -> str:
+        lines = [entry['message'] for entry in self.entries]
+        if self.dropped:
+            lines.insert(0, f'... {self.dropped} earlier entries dropped')
+        return '\n'.join(lines)
+
+
+def mirror_to_file(logger: logging.Logger, filename: str) -> QueueListener:
+    """
+    Write the logger records to the file from a background thread,
+    so that logging doesn't block the import on file writes
+    """
+    log_queue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(filename, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(log_queue, file_handler)
+    logger.addHandler(QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
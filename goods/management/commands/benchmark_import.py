@@ -0,0 +1,214 @@
+import csv
+import json
+import os
+import random
+import tempfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, Iterator, List
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import override_settings
+
+from goods.models import Category, Product, ProductImportFile
+from goods.parsing import row_fingerprint
+from goods.services import Import, supports_upsert
+from goods.utils import Rollback, chunked
+
+PHASES = ['parse', 'categories', 'create', 'update', 'upsert', 'log', 'other']
+
+
+class ProfiledImport(Import):
+    """
+    Import which records wall time and queries of each phase and, with `trace_memory`, the Python memory
+    traced by tracemalloc: the peak reached within the phase and the memory still held at its end, in kilobytes.
+    Parsing runs in the prefetch thread, its time overlaps with the other phases, and the memory of
+    the other phases includes the rows parsed meanwhile. The parse phase itself has no memory figures,
+    resetting the peak from its thread would cut the peaks of the other phases.
+    """
+
+    def __init__(self, *args, trace_memory: bool = False, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.trace_memory = trace_memory
+        self.phases = {name: {'time': 0.0, 'queries': 0, 'memory_kb': None, 'peak_memory_kb': None}
+                       for name in PHASES}
+        self.peak_memory_kb = None
+        self.current = threading.local()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        previous = getattr(self.current, 'name', None)
+        self.current.name = name
+        trace = self.trace_memory and name != 'parse'
+        if trace:
+            tracemalloc.reset_peak()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name]['time'] += perf_counter() - start
+            if trace:
+                self._record_memory(name)
+            self.current.name = previous
+
+    def _record_memory(self, name: str) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        phase = self.phases[name]
+        phase['memory_kb'] = current // 1024
+        phase['peak_memory_kb'] = max(phase['peak_memory_kb'] or 0, peak // 1024)
+        self.peak_memory_kb = max(self.peak_memory_kb or 0, phase['peak_memory_kb'])
+
+    def count_query(self, execute, sql, params, many, context):
+        self.phases[getattr(self.current, 'name', None) or 'other']['queries'] += 1
+        return execute(sql, params, many, context)
+
+    def import_data(self, *args, **kwargs) -> bool:
+        if self.trace_memory:
+            tracemalloc.start()
+        try:
+            start = perf_counter()
+            with connection.execute_wrapper(self.count_query):
+                result = super().import_data(*args, **kwargs)
+            total = perf_counter() - start
+            if self.trace_memory:
+                # the peak since the last phase, the whole run peak is the largest one
+                self._record_memory('other')
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+        measured = sum(phase['time'] for name, phase in self.phases.items() if name not in ('parse', 'other'))
+        self.phases['other']['time'] = total - measured
+        return result
+
+    def read_rows(self, *args, **kwargs) -> Iterator:
+        rows = super().read_rows(*args, **kwargs)
+        while True:
+            with self.phase('parse'):
+                row = next(rows, None)
+            if row is None:
+                return
+            yield row
+
+    def _get_or_create_categories(self, *args, **kwargs):
+        with self.phase('categories'):
+            return super()._get_or_create_categories(*args, **kwargs)
+
+    def create_products(self, *args, **kwargs) -> None:
+        with self.phase('create'):
+            super().create_products(*args, **kwargs)
+
+    def update_products(self, *args, **kwargs) -> None:
+        with self.phase('update'):
+            super().update_products(*args, **kwargs)
+
+    def upsert_products(self, *args, **kwargs) -> None:
+        with self.phase('upsert'):
+            super().upsert_products(*args, **kwargs)
+
+    def save_progress(self) -> None:
+        with self.phase('log'):
+            super().save_progress()
+
+    def save_log_info(self) -> None:
+        with self.phase('log'):
+            super().save_log_info()
+
+
+class Command(BaseCommand):
+    """
+    Импорт синтетических прайсов разного размера. Для каждого размера и режима записи выводит
+    время и запросы по фазам импорта, с --memory также память Python по фазам, с --json также в машиночитаемом виде
+    """
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000])
+        parser.add_argument('--updated', type=float, default=0.3, help='share of rows changing existing products')
+        parser.add_argument('--unchanged', type=float, default=0.2,
+                            help='share of rows equal to the last import of existing products')
+        parser.add_argument('--invalid', type=float, default=0.01, help='share of rows failing validation')
+        parser.add_argument('--categories', type=int, default=10, help='number of distinct categories')
+        parser.add_argument('--modes', nargs='+', choices=['upsert', 'two-phase'], default=['upsert', 'two-phase'])
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=0, help='processes parsing the file')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', help='file for the results, - for stdout')
+        parser.add_argument('--memory', action='store_true',
+                            help='trace memory of each phase with tracemalloc, it slows the import down')
+
+    def handle(self, *args, **options) -> None:
+        modes = [mode for mode in options['modes'] if mode == 'two-phase' or supports_upsert()]
+        results = []
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root, IMPORT_BATCH_SIZE=options['batch_size']):
+            for size in options['sizes']:
+                name = os.path.join('import', f'benchmark_{size}.csv')
+                os.makedirs(os.path.join(media_root, 'import'), exist_ok=True)
+                existing = self._generate_feed(os.path.join(media_root, name), size, options)
+                for mode in modes:
+                    results.append(self._benchmark(name, size, existing, mode, options))
+        if options['json'] == '-':
+            self.stdout.write(json.dumps(results, indent=2))
+        elif options['json']:
+            with open(options['json'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def _benchmark(self, name: str, size: int, existing: List[Dict], mode: str, options: Dict) -> Dict:
+        try:
+            with transaction.atomic():
+                categories = {}
+                for item in existing:
+                    if item['category'] not in categories:
+                        categories[item['category']] = Category.objects.create(name=item['category'])
+                for chunk in chunked(existing, 5000):
+                    Product.objects.bulk_create([Product(**dict(item, category=categories[item['category']]))
+                                                 for item in chunk])
+                obj = ProductImportFile.objects.create(file=name)
+                imp = ProfiledImport(obj, upsert=mode == 'upsert', workers=options['workers'],
+                                     trace_memory=options['memory'])
+                start = perf_counter()
+                imp.import_data()
+                elapsed = perf_counter() - start
+                raise Rollback
+        except Rollback:
+            pass
+        result = {'rows': size, 'mode': mode, 'database': connection.vendor,
+                  'batch_size': options['batch_size'], 'workers': options['workers'],
+                  'wall_time': round(elapsed, 3), 'rows_per_second': round(size / elapsed),
+                  'peak_memory_kb': imp.peak_memory_kb,
+                  'created': imp.rows_created, 'updated': imp.rows_updated, 'unchanged': imp.rows_unchanged,
+                  'errors': imp.errors, 'warnings': imp.warnings,
+                  'phases': {name: dict(phase, time=round(phase['time'], 3))
+                             for name, phase in imp.phases.items()}}
+        if options['json'] != '-':
+            phases = ', '.join(f'{name} {phase["time"]:.2f}s/{phase["queries"]}q'
+                               for name, phase in result['phases'].items() if phase['time'] or phase['queries'])
+            memory = f', peak {imp.peak_memory_kb} kB' if options['memory'] else ''
+            self.stdout.write(f'{size} rows, {mode}: {elapsed:.2f}s, {result["rows_per_second"]} rows/s{memory} '
+                              f'({phases})')
+        return result
+
+    def _generate_feed(self, path: str, size: int, options: Dict) -> List[Dict]:
+        """
+        Write a feed of `size` rows and return the products which must exist before its import:
+        the changed ones with other prices, the unchanged ones as written by the last import
+        """
+        rng = random.Random(options['seed'])
+        updated, unchanged = int(size * options['updated']), int(size * options['unchanged'])
+        existing = []
+        with open(path, 'w', newline='') as feed:
+            writer = csv.writer(feed)
+            writer.writerow(['title', 'article', 'price', 'quantity', 'category'])
+            for i in range(size):
+                item = {'title': f'product {i}', 'article': f'b{i}', 'price': str(rng.randint(1, 1000)),
+                        'quantity': str(rng.randint(0, 100)), 'category': f'benchmark_{i % options["categories"]}'}
+                if i < updated:
+                    existing.append(dict(item, price=int(item['price']) + 1))
+                elif i < updated + unchanged:
+                    existing.append(dict(item, import_fingerprint=row_fingerprint(item)))
+                if rng.random() < options['invalid']:
+                    item['price'] = 'invalid'
+                writer.writerow(item.values())
+        return existing
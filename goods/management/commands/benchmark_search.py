@@ -0,0 +1,62 @@
+import random
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.filters import SearchFilter
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from goods.apis import ProductViewSet
+from goods.models import Category, Product
+from goods.search import TokenSearchFilter, index_products
+from goods.utils import Rollback
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sta', 'po', 'vi', 'de', 'tor', 'ban', 'gel', 'fo', 'lu', 'rin',
+             'sa', 'te', 'mo', 'chi', 'pa', 'xo', 'zen', 'bri', 'dol', 'quo', 'ny', 'har', 'wel', 'ost', 'gri']
+# about 900 distinct words, a title of three words matches a single word query ~0.3% of the time
+WORDS = [first + second for first in SYLLABLES for second in SYLLABLES]
+QUERIES = ['kalo', 'mine ruban', 'sta', 'tordol quony', 'missing']
+
+
+class Command(BaseCommand):
+    """ Сравнивает SearchFilter и поиск по индексу токенов на синтетическом каталоге """
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--sizes', nargs='+', type=int, default=[100000, 1000000])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--limit', type=int, default=8)
+
+    def handle(self, *args, **options) -> None:
+        for size in options['sizes']:
+            try:
+                with transaction.atomic():
+                    self._benchmark(size, options['repeat'], options['limit'])
+                    raise Rollback
+            except Rollback:
+                pass
+
+    def _benchmark(self, size: int, repeat: int, limit: int) -> None:
+        category = Category.objects.create(name='benchmark_category')
+        start = perf_counter()
+        Product.objects.bulk_create((Product(title=' '.join(random.sample(WORDS, 3)) + f' {i}',
+                                             article=f'b{i}', price=100, quantity=1, category=category)
+                                     for i in range(size)), batch_size=5000)
+        self.stdout.write(f'{size} products: created in {perf_counter() - start:.1f}s')
+        start = perf_counter()
+        index_products(Product.objects.filter(category=category), batch_size=5000)
+        self.stdout.write(f'{size} products: indexed in {perf_counter() - start:.1f}s')
+
+        factory = APIRequestFactory()
+        view = ProductViewSet()
+        for query in QUERIES:
+            request = Request(factory.get('/api/products/', {'search': query}))
+            for backend in (SearchFilter(), TokenSearchFilter()):
+                start = perf_counter()
+                for _ in range(repeat):
+                    queryset = backend.filter_queryset(request, Product.objects.select_related('category'), view)
+                    queryset.count()
+                    list(queryset[:limit])
+                elapsed = (perf_counter() - start) / repeat * 1000
+                self.stdout.write(f'{size} products, {backend.__class__.__name__}, '
+                                  f'search={query!r}: {elapsed:.1f} ms')
@@ -0,0 +1,44 @@
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from goods.models import Category, Product
+from goods.serializers import FastProductSerializer, ProductSerializer
+from goods.services import get_products
+from goods.utils import Rollback
+
+
+class Command(BaseCommand):
+    """ Сравнивает время сериализации списка товаров ProductSerializer и FastProductSerializer """
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000])
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options) -> None:
+        try:
+            with transaction.atomic():
+                self._benchmark(options['sizes'], options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def _benchmark(self, sizes, repeat: int) -> None:
+        categories = [Category.objects.create(name=f'benchmark_category_{i}') for i in range(5)]
+        Product.objects.bulk_create((Product(title=f'product "{i}"', article=f'b{i}', price=f'{i}.5',
+                                             quantity=i, category=categories[i % 5])
+                                     for i in range(max(sizes))), batch_size=5000)
+        for size in sizes:
+            queryset = get_products().filter(category__in=categories).order_by('id')[:size]
+            fast_queryset = queryset.values(*FastProductSerializer.value_fields)
+            # fetch rows beforehand, only serialization is measured
+            rows = {ProductSerializer: list(queryset), FastProductSerializer: list(fast_queryset)}
+            timings = []
+            for serializer_class, items in rows.items():
+                start = perf_counter()
+                for _ in range(repeat):
+                    JSONRenderer().render(serializer_class(items, many=True).data)
+                timings.append(f'{serializer_class.__name__} {(perf_counter() - start) / repeat * 1000:.1f} ms')
+            self.stdout.write(f'{size} rows: ' + ', '.join(timings))
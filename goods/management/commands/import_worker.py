@@ -0,0 +1,29 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from goods.services import claim_import, run_import
+
+
+class Command(BaseCommand):
+    """ Импортирует загруженные файлы товаров из очереди в базе данных """
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--once', action='store_true', help='exit when the queue is empty')
+        parser.add_argument('--interval', type=float, default=2, help='seconds between queue checks')
+
+    def handle(self, *args, **options) -> None:
+        while True:
+            # the worker runs outside of the request cycle, drop connections broken or past CONN_MAX_AGE,
+            # unless it is called inside a transaction, as the tests do
+            if not connection.in_atomic_block:
+                close_old_connections()
+            obj = claim_import()
+            if obj:
+                status = 'complete' if run_import(obj) else 'failed'
+                self.stdout.write(f'Import {obj.file} {status}.')
+            elif options['once']:
+                return
+            else:
+                sleep(options['interval'])
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from goods.models import Product
+from goods.search import index_products
+
+
+class Command(BaseCommand):
+    """ Перестраивает поисковый индекс всех товаров """
+
+    def handle(self, *args, **options) -> None:
+        index_products(Product.objects.all())
+        self.stdout.write(self.style.SUCCESS('Search index was rebuilt.'))
@@ -31,30 +31,115 @@ class Product(models.Model):
         verbose_name='category',
     )
     title = models.CharField(max_length=100, verbose_name='product title')
-    article = models.CharField(max_length=10, verbose_name='product article')
+    article = models.CharField(max_length=10, verbose_name='product article', unique=True)
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='price')
     quantity = models.IntegerField(verbose_name='quantity')
+    # hash of the fields written by the last import, reset by any other change of the product
+    import_fingerprint = models.CharField(max_length=32, blank=True, default='')
+    # for hot products the stock is split between ProductStockShard rows, see goods.stock
+    stock_shards = models.PositiveSmallIntegerField(default=0, verbose_name='stock shards',
+                                                    help_text='Split the stock of a hot product into that many '
+                                                              'counters, 0 to keep it in the product row')
 
     def __str__(self) -> str:
         return self.title
 
+    @property
+    def total_quantity(self) -> int:
+        """
+        Stock of the product: its quantity and the quantity of its stock shards
+        """
+        if not self.stock_shards:
+            return self.quantity
+        return self.quantity + (self.shards.aggregate(total=models.Sum('quantity'))['total'] or 0)
+
     class Meta:
         verbose_name = 'product'
         verbose_name_plural = 'products'
         db_table = 'products'
 
 
+class ProductSearchToken(models.Model):
+    """
+    Search index entry: one normalized word of product title or article
+    """
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='search_tokens',
+        verbose_name='product',
+    )
+    token = models.CharField(max_length=100, verbose_name='token')
+
+    def __str__(self) -> str:
+        return self.token
+
+    class Meta:
+        verbose_name = 'search token'
+        verbose_name_plural = 'search tokens'
+        db_table = 'products_search_tokens'
+        # varchar_pattern_ops lets postgresql use the index for the LIKE 'prefix%' of the search,
+        # the other backends ignore the operator class
+        indexes = [models.Index(fields=['token', 'product'], name='search_token_product_idx'),
+                   models.Index(fields=['token'], name='search_token_prefix_idx', opclasses=['varchar_pattern_ops'])]
+
+
+class ProductStockShard(models.Model):
+    """
+    Part of the stock of a hot product. Checkouts decrement different shards,
+    so they don't all wait for the lock of the product row.
+    """
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='shards',
+        verbose_name='product',
+    )
+    number = models.PositiveSmallIntegerField(verbose_name='shard number')
+    quantity = models.IntegerField(default=0, verbose_name='quantity')
+
+    def __str__(self) -> str:
+        return f'{self.product} stock shard {self.number}'
+
+    class Meta:
+        verbose_name = 'stock shard'
+        verbose_name_plural = 'stock shards'
+        db_table = 'products_stock_shards'
+        constraints = [models.UniqueConstraint(fields=['product', 'number'], name='stock_shard_unique')]
+
+
 class ProductImportFile(models.Model):
     """
-    Model for files by importing products
+    Model for files by importing products. Saved files are queued and imported by the import_worker command
     """
+    QUEUED = 'Queued'
+    IN_PROGRESS = 'In progress'
+    COMPLETE = 'Complete'
+    FAILED = 'Failed'
+    # batches are committed one by one, the ones written before an error are kept
+    PARTIAL = 'Partially imported'
+    SKIPPED = 'Skipped'
 
     file = models.FileField(upload_to='import')
     errors = models.IntegerField(default=0)
     warnings = models.IntegerField(default=0)
     log_info = models.TextField(blank=True)
+    log_entries = models.JSONField(default=list, blank=True)
     created_at = models.DateTimeField(auto_now=True)
-    status = models.CharField(default='In progress', blank=True, max_length=24)
+    status = models.CharField(default=QUEUED, blank=True, max_length=24, db_index=True)
+    rows_processed = models.IntegerField(default=0)
+    rows_total = models.IntegerField(default=0)
+    rows_created = models.IntegerField(default=0)
+    rows_updated = models.IntegerField(default=0)
+    rows_unchanged = models.IntegerField(default=0)
+    file_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    dry_run = models.BooleanField(default=False, help_text='Only count new, changed and unchanged products')
+    # updated by the worker with every saved batch, an import in progress without it for IMPORT_STALE_TIMEOUT
+    # is considered abandoned by a crashed worker and is queued again
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    # products with an import fingerprint once the import is complete, only imports set fingerprints,
+    # so a lower number later means some of them were changed or deleted since
+    fingerprinted_products = models.IntegerField(default=0)
 
     def __str__(self) -> str:
         return f'Import {str(self.file)} from {str(self.created_at)}'
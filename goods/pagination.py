@@ -0,0 +1,52 @@
+from typing import Type
+
+from django.core.paginator import Paginator
+from django.http import QueryDict
+from django.utils.functional import cached_property
+from rest_framework.pagination import BasePagination, CursorPagination, \
+    LimitOffsetPagination
+
+from goods.cache import get_or_build
+from goods.exceptions import WrongQueryParams
+
+
+class ProductCursorPagination(CursorPagination):
+    """
+    Keyset pagination over the product primary key.
+    Doesn't count rows and doesn't scan skipped rows, so deep pages are as fast as the first one.
+    """
+    ordering = 'id'
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
+PAGINATION_MODES = {
+    'offset': LimitOffsetPagination,
+    'cursor': ProductCursorPagination,
+}
+
+
+def get_pagination_class(query_params: QueryDict) -> Type[BasePagination]:
+    """
+    Select pagination by the `pagination` parameter. Offset mode is the default,
+    a request with a `cursor` parameter is always served in cursor mode.
+    """
+    default_mode = 'cursor' if query_params.get('cursor') else 'offset'
+    mode = query_params.get('pagination', default_mode)
+    if mode not in PAGINATION_MODES:
+        raise WrongQueryParams
+    return PAGINATION_MODES[mode]
+
+
+class CachedCountPaginator(Paginator):
+    """
+    Paginator which takes the number of objects from cache, stored under `count_cache_key`
+    """
+
+    def __init__(self, *args, count_cache_key: str, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.count_cache_key = count_cache_key
+
+    @cached_property
+    def count(self) -> int:
+        return get_or_build(self.count_cache_key, lambda: Paginator.count.func(self))
@@ -0,0 +1,245 @@
+"""
+Parsing and validation of import files. The module doesn't depend on Django,
+so its functions can run in worker processes of the parallel import.
+"""
+import bz2
+import codecs
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+from collections import deque
+from concurrent.futures import Executor
+from csv import DictReader, reader
+from itertools import chain
+from typing import BinaryIO, Callable, Dict, Iterator, List, Sequence, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def is_valid_row(item: Dict) -> bool:
+    """
+    Row has integer price and quantity and non-empty title, category and article
+    """
+    try:
+        int(item['price'])
+        int(item['quantity'])
+        return all(len(item[field]) > 0 for field in ('title', 'category', 'article'))
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+def row_fingerprint(item: Dict) -> str:
+    """
+    Hash of the imported fields of a valid row
+    """
+    values = [item['title'], item['article'], str(int(item['price'])), str(int(item['quantity'])), item['category']]
+    return hashlib.md5('\x1f'.join(values).encode()).hexdigest()
+
+
+def validate_rows(rows: Iterator[Dict]) -> Iterator[Tuple[Dict, bool]]:
+    for item in rows:
+        yield item, is_valid_row(item)
+
+
+def read_csv(stream: BinaryIO, delimiter: str = ',', quotechar: str = '"') -> Iterator[Dict]:
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    return DictReader(text, delimiter=delimiter, quotechar=quotechar)
+
+
+def read_ndjson(stream: BinaryIO, delimiter: str = ',', quotechar: str = '"') -> Iterator[Dict]:
+    """
+    One json object per line. Values are converted to strings, as if they were read from csv,
+    a line which is not a json object gives an empty row, which fails validation
+    """
+    for line in io.TextIOWrapper(stream, encoding='utf-8-sig'):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = None
+        if not isinstance(item, dict):
+            yield {}
+            continue
+        yield {key: value if value is None else str(value) for key, value in item.items()}
+
+
+READERS: Dict[str, Callable[..., Iterator[Dict]]] = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+}
+
+
+def _open_zstd(file: BinaryIO) -> BinaryIO:
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(file))
+
+
+# magic numbers of the compressed files, zstd is supported when the zstandard package is installed
+DECOMPRESSORS: List[Tuple[bytes, Callable[[BinaryIO], BinaryIO]]] = [
+    (b'\x1f\x8b', lambda file: gzip.GzipFile(fileobj=file)),
+    (b'BZh', bz2.BZ2File),
+    (b'\xfd7zXZ\x00', lzma.LZMAFile),
+]
+if zstandard is not None:
+    DECOMPRESSORS.append((b'\x28\xb5\x2f\xfd', _open_zstd))
+# raised when a compressed file is truncated or corrupted
+DECOMPRESSION_ERRORS: Tuple = (EOFError, OSError, lzma.LZMAError) + \
+                              ((zstandard.ZstdError, ) if zstandard is not None else ())
+
+
+def _peek(stream: BinaryIO, size: int) -> bytes:
+    if hasattr(stream, 'peek'):
+        return stream.peek(size)[:size]
+    position = stream.tell()
+    data = stream.read(size)
+    stream.seek(position)
+    return data
+
+
+def open_import_file(file: BinaryIO) -> Tuple[BinaryIO, str]:
+    """
+    Stream of the decompressed file and its format: ndjson if the first line is a json object, csv otherwise.
+    The file is decompressed while it is read, never whole.
+    """
+    head = _peek(file, 6)
+    for magic, decompress in DECOMPRESSORS:
+        if head.startswith(magic):
+            file = decompress(file)
+            break
+    head = _peek(file, 64).removeprefix(codecs.BOM_UTF8).lstrip()
+    return file, 'ndjson' if head.startswith(b'{') else 'csv'
+
+
+def split_records(file: BinaryIO, chunk_size: int, quotechar: str = '"',
+                  block_size: int = 1 << 20) -> Iterator[int]:
+    """
+    Offsets of record starts about `chunk_size` bytes apart, the first one is the end of the header.
+    A newline inside a quoted field doesn't end a record, so the quotes are counted along the way.
+    A literal quote in an unquoted field throws the count off, such offsets are caught by `parse_chunk`.
+    """
+    quote = quotechar.encode()
+    quoted, offset, next_cut = False, 0, 0
+    while block := file.read(block_size):
+        pos = 0
+        while pos < len(block):
+            if offset + pos < next_cut:
+                skip_to = min(len(block), next_cut - offset)
+                quoted ^= block.count(quote, pos, skip_to) % 2 == 1
+                pos = skip_to
+                continue
+            newline = block.find(b'\n', pos)
+            if newline == -1:
+                quoted ^= block.count(quote, pos) % 2 == 1
+                break
+            quoted ^= block.count(quote, pos, newline) % 2 == 1
+            pos = newline + 1
+            if not quoted:
+                yield offset + pos
+                next_cut = offset + pos + chunk_size
+        offset += len(block)
+
+
+def read_header(path: str, end: int, delimiter: str = ',', quotechar: str = '"') -> List[str]:
+    with open(path, 'rb') as file:
+        text = file.read(end).decode('utf-8-sig')
+    return next(reader(io.StringIO(text, newline=''), delimiter=delimiter, quotechar=quotechar), [])
+
+
+class SplitError(ValueError):
+    """
+    Chunk of the file ends inside a quoted field
+    """
+
+
+class _ChunkLines:
+    """
+    Lines of a chunk for the csv reader, remembering whether the reader has run out of them
+    """
+
+    def __init__(self, text: str) -> None:
+        self.lines = iter(io.StringIO(text, newline=''))
+        self.exhausted = False
+
+    def __iter__(self) -> '_ChunkLines':
+        return self
+
+    def __next__(self) -> str:
+        try:
+            return next(self.lines)
+        except StopIteration:
+            self.exhausted = True
+            raise
+
+
+def parse_chunk(path: str, start: int, end: int, fieldnames: Sequence[str],
+                delimiter: str = ',', quotechar: str = '"') -> List[Tuple[Dict, bool]]:
+    """
+    Read and validate the rows between two record boundaries of the file.
+    A record completed by the end of the chunk rather than by a newline means the chunk was cut
+    inside a quoted field, SplitError is raised then, unless it is the end of the file.
+    """
+    with open(path, 'rb') as file:
+        file.seek(start)
+        text = file.read(end - start).decode('utf-8')
+        last = end >= os.fstat(file.fileno()).st_size
+    lines = _ChunkLines(text)
+    rows = DictReader(lines, fieldnames=fieldnames, delimiter=delimiter, quotechar=quotechar)
+    result = []
+    for item in validate_rows(rows):
+        if lines.exhausted and not last:
+            raise SplitError(f'Chunk {start}-{end} ends inside a quoted field')
+        result.append(item)
+    return result
+
+
+def parse_serial(path: str, start: int, fieldnames: Sequence[str],
+                 delimiter: str = ',', quotechar: str = '"') -> Iterator[Tuple[Dict, bool]]:
+    """
+    Read and validate the rows from a record boundary to the end of the file in the current process
+    """
+    with open(path, 'rb') as file:
+        file.seek(start)
+        text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+        yield from validate_rows(DictReader(text, fieldnames=fieldnames, delimiter=delimiter, quotechar=quotechar))
+
+
+def parse_parallel(executor: Executor, path: str, chunk_size: int, workers: int,
+                   delimiter: str = ',', quotechar: str = '"') -> Iterator[Tuple[Dict, bool]]:
+    """
+    Parse and validate the file in worker processes, yielding rows in the file order.
+    At most two chunks per worker are in flight, so memory doesn't grow with the file size.
+    Once a chunk turns out to be cut inside a quoted field, the rest of the file is parsed serially.
+    """
+    with open(path, 'rb') as file:
+        offsets = split_records(file, chunk_size, quotechar)
+        header_end = next(offsets, None)
+        if header_end is None:
+            return
+        fieldnames = read_header(path, header_end, delimiter, quotechar)
+        size = os.fstat(file.fileno()).st_size
+        pending = deque()
+        start = header_end
+        try:
+            for end in chain(offsets, [size]):
+                if end <= start:
+                    continue
+                pending.append((start, executor.submit(parse_chunk, path, start, end, fieldnames,
+                                                       delimiter, quotechar)))
+                start = end
+                if len(pending) >= workers * 2:
+                    yield from pending[0][1].result()
+                    pending.popleft()
+            while pending:
+                yield from pending[0][1].result()
+                pending.popleft()
+        except SplitError:
+            # the chunks before the failed one were cut correctly, it starts at a record boundary
+            for _, future in pending:
+                future.cancel()
+            yield from parse_serial(path, pending[0][0], fieldnames, delimiter, quotechar)
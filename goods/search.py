@@ -0,0 +1,73 @@
+import re
+from typing import List, Set
+
+from django.db.models import Count, IntegerField, OuterRef, QuerySet, Subquery
+from django.db.models.functions import Coalesce
+from rest_framework.filters import BaseFilterBackend
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from goods.models import Product, ProductSearchToken
+from goods.utils import chunked
+
+TOKEN_RE = re.compile(r'[^\W_]+')
+TOKEN_MAX_LENGTH = 100
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lowercase words without duplicates, keeping their order
+    """
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower()):
+        token = token[:TOKEN_MAX_LENGTH]
+        if token not in tokens:
+            tokens.append(token)
+    return tokens
+
+
+def product_tokens(title: str, article: str) -> Set[str]:
+    return set(tokenize(title)) | set(tokenize(article))
+
+
+def index_products(products: QuerySet[Product], batch_size: int = 1000) -> None:
+    """
+    Rebuild search tokens of the given products
+    """
+    rows = products.values_list('id', 'title', 'article').order_by()
+    for chunk in chunked(rows.iterator(chunk_size=batch_size), batch_size):
+        ProductSearchToken.objects.filter(product_id__in=[row[0] for row in chunk]).delete()
+        ProductSearchToken.objects.bulk_create([ProductSearchToken(product_id=product_id, token=token)
+                                                for product_id, title, article in chunk
+                                                for token in product_tokens(title, article)],
+                                               batch_size=batch_size)
+
+
+def search_products(queryset: QuerySet[Product], query: str) -> QuerySet[Product]:
+    """
+    Every word of the query must be a prefix of some word of the product title or article.
+    Products are ordered by the number of exactly matched words.
+    """
+    terms = tokenize(query)
+    if not terms:
+        return queryset
+    for term in terms:
+        # LIKE 'term%' is served by the search_token_prefix_idx index on postgresql in any collation
+        matched = ProductSearchToken.objects.filter(token__startswith=term)
+        queryset = queryset.filter(id__in=matched.values('product_id'))
+    exact_matches = ProductSearchToken.objects.filter(product=OuterRef('pk'), token__in=terms)\
+                                              .values('product')\
+                                              .annotate(matches=Count('*'))\
+                                              .values('matches')
+    return queryset.annotate(relevance=Coalesce(Subquery(exact_matches, output_field=IntegerField()), 0))\
+                   .order_by('-relevance', 'id')
+
+
+class TokenSearchFilter(BaseFilterBackend):
+    """
+    Product search over the token index, a replacement of SearchFilter for `?search=`
+    """
+    search_param = api_settings.SEARCH_PARAM
+
+    def filter_queryset(self, request: Request, queryset: QuerySet, view) -> QuerySet:
+        return search_products(queryset, request.query_params.get(self.search_param, ''))
@@ -1,3 +1,5 @@
+from typing import Dict
+
 from rest_framework import serializers
 
 from goods.models import Product, Category
@@ -12,8 +14,35 @@ class CategorySerializer(serializers.HyperlinkedModelSerializer):
 
 class ProductSerializer(serializers.HyperlinkedModelSerializer):
     category = CategorySerializer()
+    quantity = serializers.IntegerField(source='total_quantity', read_only=True)
 
     class Meta:
         model = Product
         fields = ['id', 'title', 'article', 'category', 'price', 'quantity']
         depth = 1
+
+
+class FastProductSerializer(serializers.BaseSerializer):
+    """
+    Read-only ProductSerializer replacement for lists: builds the same output
+    straight from `values()` rows, without per-field serializer machinery.
+    A view using it gets its queryset converted with `value_fields`,
+    the quantity is the `stock` annotation of goods.services.get_products.
+    """
+    value_fields = ('id', 'title', 'article', 'category_id', 'category__name', 'price', 'stock')
+    price_field = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+    def to_representation(self, instance) -> Dict:
+        if isinstance(instance, Product):
+            instance = {'id': instance.id, 'title': instance.title, 'article': instance.article,
+                        'category_id': instance.category_id, 'category__name': instance.category.name,
+                        'price': instance.price,
+                        'stock': instance.stock if hasattr(instance, 'stock') else instance.total_quantity}
+        return {
+            'id': instance['id'],
+            'title': instance['title'],
+            'article': instance['article'],
+            'category': {'id': instance['category_id'], 'name': instance['category__name']},
+            'price': self.price_field.to_representation(instance['price']),
+            'quantity': instance['stock'],
+        }
@@ -1,170 +1,480 @@
+import hashlib
 import json
 import logging
-from csv import DictReader
-from datetime import datetime
-from typing import List, Dict, Union
+import multiprocessing
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from csv import writer
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple, Union
 
-from django.core import serializers
-from django.db.models import QuerySet
-from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, DecimalField, F, Max, Q, QuerySet, Sum
+from django.utils import timezone
 
+from goods.cache import bump_catalog_version, bump_prices_version, categories
+from goods.logs import ImportLogCollector, format_articles, import_extra, mirror_to_file
 from goods.models import Category, Product, ProductImportFile
+from goods.parsing import DECOMPRESSION_ERRORS, READERS, open_import_file, parse_parallel, row_fingerprint, validate_rows
+from goods.search import index_products
+from goods.stock import distribute_stock, stock_quantity
+from goods.utils import chunked, prefetch
 from shop.models import Purchase
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-formatter = logging.Formatter('%(message)s')
-fh = logging.FileHandler('import_log.txt', encoding='utf-8')
-fh.setFormatter(formatter)
-logger.addHandler(fh)
+if settings.IMPORT_LOG_FILE:
+    mirror_to_file(logger, settings.IMPORT_LOG_FILE)
 
 
 def get_products(**kwargs) -> Union[QuerySet[Product], Product]:
     if kwargs.get('id'):
         return Product.objects.get(id=kwargs.get('id'))
+    products = Product.objects.select_related('category').annotate(stock=stock_quantity())
     if kwargs.get('category_id'):
-        category = get_object_or_404(Category, id=kwargs['category_id'])
-        if category:
-            return Product.objects.select_related('category').filter(category=category)
+        category_id = categories.get_id(category_id=kwargs['category_id'])
+        return products.filter(category_id=category_id)
     elif kwargs.get('category_name'):
-        category = get_object_or_404(Category, name=kwargs['category_name'])
-        if category:
-            return Product.objects.select_related('category').filter(category=category)
-    return Product.objects.select_related('category').all()
+        category_id = categories.get_id(name=kwargs['category_name'])
+        return products.filter(category_id=category_id)
+    return products.all()
+
+
+EXPORT_FIELDS = ['title', 'article', 'price', 'quantity', 'category']
+
+
+class _Echo:
+    """
+    File-like object for csv.writer which returns the written line instead of storing it
+    """
+    def write(self, value: str) -> str:
+        return value
+
+
+def export_products(products: QuerySet[Product], output: str, chunk_size: int = 2000) -> Iterator[bytes]:
+    """
+    Stream products as csv with the import file columns or as NDJSON, one chunk of rows at a time
+    """
+    rows = products.order_by('id')\
+                   .values_list('title', 'article', 'price', stock_quantity(), 'category__name')\
+                   .iterator(chunk_size=chunk_size)
+    csv_writer = writer(_Echo())
+    if output == 'csv':
+        yield csv_writer.writerow(EXPORT_FIELDS).encode()
+    chunk = []
+    for row in rows:
+        if output == 'csv':
+            chunk.append(csv_writer.writerow(row))
+        else:
+            chunk.append(json.dumps(dict(zip(EXPORT_FIELDS, row)), default=str, ensure_ascii=False) + '\n')
+        if len(chunk) == chunk_size:
+            yield ''.join(chunk).encode()
+            chunk = []
+    if chunk:
+        yield ''.join(chunk).encode()
+
+
+def gzip_stream(stream: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for data in stream:
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+UPSERT_FIELDS = ['category', 'title', 'article', 'price', 'quantity', 'import_fingerprint']
+# written with their defaults on insert only, raw inserts don't get the model defaults otherwise
+UPSERT_INSERT_ONLY_FIELDS = ['stock_shards']
+
+
+def supports_upsert() -> bool:
+    return connection.vendor in ('postgresql', 'sqlite')
+
+
+def upsert_products(rows: List[Dict]) -> None:
+    """
+    Insert products or update the existing ones with the same article by `INSERT ... ON CONFLICT`,
+    one statement per batch (sqlite splits batches to fit its limit of query parameters)
+    """
+    fields = [Product._meta.get_field(name) for name in UPSERT_FIELDS + UPSERT_INSERT_ONLY_FIELDS]
+    quote_name = connection.ops.quote_name
+    columns = ', '.join(quote_name(field.column) for field in fields)
+    updates = ', '.join(f'{quote_name(field.column)} = excluded.{quote_name(field.column)}'
+                        for field in fields if field.name in UPSERT_FIELDS and field.name != 'article')
+    row_placeholder = f'({", ".join(["%s"] * len(fields))})'
+    defaults = {name: Product._meta.get_field(name).get_default() for name in UPSERT_INSERT_ONLY_FIELDS}
+    with transaction.atomic(), connection.cursor() as cursor:
+        for batch in chunked(rows, connection.ops.bulk_batch_size(fields, rows)):
+            params = [field.get_db_prep_save(field.to_python(row[field.name].pk if field.is_relation
+                                                              else row.get(field.name, defaults.get(field.name))),
+                                             connection)
+                      for row in batch for field in fields]
+            cursor.execute(f'INSERT INTO {quote_name(Product._meta.db_table)} ({columns}) '
+                           f'VALUES {", ".join([row_placeholder] * len(batch))} '
+                           f'ON CONFLICT ({quote_name("article")}) DO UPDATE SET {updates}', params)
 
 
 class Import:
-    def __init__(self, obj: ProductImportFile) -> None:
+    def __init__(self, obj: ProductImportFile, upsert: Optional[bool] = None,
+                 workers: Optional[int] = None) -> None:
         self.obj = obj
+        self.upsert = (settings.IMPORT_UPSERT if upsert is None else upsert) and supports_upsert()
+        self.workers = settings.IMPORT_WORKERS if workers is None else workers
+        self.dry_run = obj.dry_run
+        # fingerprints of the rows a dry run would have written, by article
+        self.dry_run_written = {}
         self.message_data = []
+        self.log = ImportLogCollector(obj.pk, max_entries=settings.IMPORT_LOG_MAX_ENTRIES)
+        self.errors = 0
+        self.warnings = 0
+        self.rows_processed = 0
+        self.rows_created = 0
+        self.rows_updated = 0
+        self.rows_unchanged = 0
 
     def import_data(self, delimiter: str = ',', quotechar: str = '"') -> bool:
         """
-        Метод импорта продуктов из файла
+        Метод импорта продуктов из файла.
+        Файл читается потоково, пачками по IMPORT_BATCH_SIZE строк
         """
         start_time = datetime.now()
-        logger.info(f'{self.obj.file} starts import at {start_time}>')
-        products_file = self.obj.file.read()
+        with self.collect_logs():
+            logger.info(f'{self.obj.file} starts import at {start_time}>', extra=import_extra(self.obj.pk))
+            self.obj.file.open('rb')
+            try:
+                # the next batch is read and validated in a background thread while the current one is written
+                for batch in prefetch(chunked(self.read_rows(delimiter, quotechar), settings.IMPORT_BATCH_SIZE)):
+                    self.import_batch(batch)
+                    self.rows_processed += len(batch)
+                    self.save_progress()
+            except (UnicodeDecodeError, *DECOMPRESSION_ERRORS) as err:
+                logger.error(f'Error: Not a valid import', exc_info=err, extra=import_extra(self.obj.pk))
+                self.errors += 1
+                self.fail()
+                return False
+            finally:
+                self.obj.file.close()
+            logger.info(f'{self.obj.file} finished importing which started in {start_time}>',
+                        extra=import_extra(self.obj.pk))
+        self.obj.status = ProductImportFile.COMPLETE
+        if not self.dry_run:
+            self.obj.fingerprinted_products = Product.objects.exclude(import_fingerprint='').count()
+        self.save_log_info()
+        return True
+
+    def read_rows(self, delimiter: str = ',', quotechar: str = '"') -> Iterator[Tuple[Dict, bool]]:
+        """
+        Строки файла вместе с результатом проверки, в порядке файла.
+        Формат (csv или ndjson) и сжатие (gzip, bz2, xz, zstd) определяются по содержимому файла.
+        При IMPORT_WORKERS > 1 несжатый csv разбирается и проверяется в нескольких процессах
+        """
+        stream, file_format = open_import_file(self.obj.file)
+        path = self._get_local_path()
+        if self.workers > 1 and path and file_format == 'csv' and stream is self.obj.file:
+            # forking this multi-threaded process (prefetch thread, log listener) may deadlock a worker,
+            # goods.parsing doesn't need Django, so the workers start from a clean interpreter instead
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method))
+            try:
+                yield from parse_parallel(executor, path, settings.IMPORT_CHUNK_BYTES, self.workers,
+                                          delimiter, quotechar)
+            finally:
+                executor.shutdown(cancel_futures=True)
+            return
+        yield from validate_rows(READERS[file_format](stream, delimiter, quotechar))
+
+    def _get_local_path(self) -> Optional[str]:
         try:
-            products_str = products_file.decode().split('\n')
-        except UnicodeDecodeError as err:
-            logger.error(f'Error: Not a valid import', exc_info=err)
-            return False
-        csv_reader = DictReader(products_str, delimiter=delimiter, quotechar=quotechar)
-        data = []
-        for row in csv_reader:
-            data.append(dict(row))
-        all_products = [item['fields'] for item in json.loads(
-            serializers.serialize('json', Product.objects.select_related('category').all())
-        )]
-        set_create = set.difference(
-            set([item['article'] for item in data]),
-            set([item['article'] for item in all_products])
-        )
-
-        create_data = [item for item in data if item['article'] in set_create]
-        update_data = [item for item in data if item['article'] not in set_create]
-        if create_data:
-            self.create_products(create_data)
+            return self.obj.file.path
+        except NotImplementedError:
+            return None
+
+    def import_batch(self, rows: List[Tuple[Dict, bool]]) -> None:
+        # a repeated article is imported once, from its last row
+        rows = list({item.get('article') or i: (item, valid) for i, (item, valid) in enumerate(rows)}.values())
+        found = Product.objects.filter(article__in={item.get('article') for item, _ in rows})\
+                               .values_list('article', 'import_fingerprint', 'pk', 'stock_shards', 'price')
+        # checkouts take the stock of a sharded product from its shards without resetting the fingerprint,
+        # so such a product is always written and its new quantity is distributed between the shards
+        existing = {article: '' if shards else fingerprint for article, fingerprint, _, shards, _ in found}
+        sharded = {article: pk for article, _, pk, shards, _ in found if shards}
+        prices = {article: price for article, *_, price in found}
+        if self.dry_run:
+            # nothing is written, so an article of an earlier batch is taken as if its row had been written
+            existing.update((item['article'], self.dry_run_written[item['article']]) for item, _ in rows
+                            if item.get('article') in self.dry_run_written and item['article'] not in sharded)
+        create_data = self._get_cleaned_data([row for row in rows if row[0].get('article') not in existing])
+        update_data = self._get_cleaned_data([row for row in rows if row[0].get('article') in existing])
+        for item in create_data + update_data:
+            item['import_fingerprint'] = row_fingerprint(item)
+        # rows equal to the last imported ones are not written again
+        unchanged = [item for item in update_data if item['import_fingerprint'] == existing[item['article']]]
+        update_data = [item for item in update_data if item['import_fingerprint'] != existing[item['article']]]
         if update_data:
-            self.update_products(update_data)
-        logger.info(f'{self.obj.file} finished importing which started in {start_time}>')
-        self.save_log_info(start_time)
-        return True
+            self._log_updates(update_data)
+        if self.dry_run:
+            self.dry_run_written.update((item['article'], item['import_fingerprint'])
+                                        for item in create_data + update_data)
+            self.rows_created += len(create_data)
+            self.rows_updated += len(update_data)
+            self.rows_unchanged += len(unchanged)
+            return
+        self._get_or_create_categories(create_data + update_data)
+        # the new quantity of a sharded product and its redistribution are seen by checkouts together
+        with transaction.atomic():
+            if self.upsert:
+                self.upsert_products(create_data + update_data)
+            else:
+                if create_data:
+                    self.create_products(create_data)
+                if update_data:
+                    self.update_products(update_data)
+            if any(Decimal(item['price']) != prices[item['article']] for item in update_data):
+                bump_prices_version()
+            written_sharded = [sharded[item['article']] for item in update_data if item['article'] in sharded]
+            if written_sharded:
+                distribute_stock(written_sharded)
+        # counted once written, so that the counters of a failed import tell what it has kept
+        self.rows_created += len(create_data)
+        self.rows_updated += len(update_data)
+        self.rows_unchanged += len(unchanged)
 
-    def save_log_info(self, start_time: datetime) -> None:
+    def scan_file(self) -> Tuple[int, str]:
         """
-        Сохранение части лога в модель файла импорта
+        Количество строк файла без заголовка, для отображения прогресса, и хэш файла.
+        Сжатый файл для подсчета строк распаковывается потоково
         """
+        lines, file_hash = 0, hashlib.sha256()
+        self.obj.file.open('rb')
+        try:
+            for chunk in self.obj.file.chunks():
+                file_hash.update(chunk)
+            self.obj.file.seek(0)
+            stream, file_format = open_import_file(self.obj.file)
+            while chunk := stream.read(self.obj.file.DEFAULT_CHUNK_SIZE):
+                lines += chunk.count(b'\n')
+        finally:
+            self.obj.file.close()
+        return max(lines - 1 if file_format == 'csv' else lines, 0), file_hash.hexdigest()
 
-        with open('import_log.txt', 'r') as imp_log:
-            result = imp_log.read()
-            file_log = result[result.find(f'Starts import at {start_time}>'):result.find(
-                f'Finished importing which started in {start_time}')]
-            self.obj.log_info = file_log
-            self.obj.errors = file_log.count('Error:')
-            self.obj.warnings = file_log.count('Warning:')
-            self.obj.status = 'Complete'
-            self.obj.save()
+    def is_repeated_file(self) -> bool:
+        """
+        Файл совпадает с файлом последнего импорта, который менял базу, этот импорт выполнен полностью,
+        и с тех пор ни один товар с отпечатком импорта не изменен и не удален.
+        Остатки товаров с шардами импорт всегда записывает заново, при них файл не пропускается
+        """
+        last = ProductImportFile.objects.filter(status__in=[ProductImportFile.COMPLETE, ProductImportFile.PARTIAL,
+                                                            ProductImportFile.FAILED],
+                                                dry_run=False)\
+                                        .exclude(pk=self.obj.pk)\
+                                        .order_by('-id')\
+                                        .first()
+        if last is None or last.status != ProductImportFile.COMPLETE or last.file_hash != self.obj.file_hash:
+            return False
+        fingerprinted = Product.objects.exclude(import_fingerprint='')
+        return fingerprinted.count() == last.fingerprinted_products and \
+            not fingerprinted.filter(stock_shards__gt=0).exists()
 
-    def _get_cleaned_data(self, data: List[Dict]) -> List:
-        cleaned_data = []
-        for item in data:
-            try:
-                int(item['price'])
-                int(item['quantity'])
-                assert len(item['title']) > 0
-                assert len(item['category']) > 0
-                assert len(item['article']) > 0
-                cleaned_data.append(item)
-            except (ValueError, AssertionError, KeyError):
-                self.message_data.append(item.get('article', 'unknown'))
+    def save_progress(self) -> None:
+        ProductImportFile.objects.filter(pk=self.obj.pk).update(rows_processed=self.rows_processed,
+                                                                rows_created=self.rows_created,
+                                                                rows_updated=self.rows_updated,
+                                                                rows_unchanged=self.rows_unchanged,
+                                                                errors=self.errors,
+                                                                warnings=self.warnings,
+                                                                heartbeat_at=timezone.now())
+
+    @contextmanager
+    def collect_logs(self) -> Iterator[None]:
+        """
+        Записи лога внутри блока попадают в лог этого импорта, вложенные блоки не снимают обработчик раньше времени
+        """
+        attached = self.log in logger.handlers
+        logger.addHandler(self.log)
+        try:
+            yield
+        finally:
+            if not attached:
+                logger.removeHandler(self.log)
+
+    def fail(self) -> None:
+        """
+        Пачки сохраняются по одной: записанные до ошибки остаются в базе, тогда импорт помечается
+        частично выполненным, а счетчики показывают записанные товары
+        """
+        if self.rows_created or self.rows_updated:
+            self.obj.status = ProductImportFile.PARTIAL
+            with self.collect_logs():
+                logger.error(f'Error: {self.obj.file} stopped after {self.rows_processed} rows, '
+                             f'{self.rows_created} created and {self.rows_updated} updated products are kept.',
+                             extra=import_extra(self.obj.pk))
+        else:
+            self.obj.status = ProductImportFile.FAILED
+        self.save_log_info()
+
+    def save_log_info(self) -> None:
+        """
+        Сохранение счетчиков и записей лога этого импорта в модель файла импорта
+        """
+        self.obj.log_entries = self.log.get_entries()
+        self.obj.log_info = self.log.get_text()
+        self.obj.rows_processed = self.rows_processed
+        self.obj.rows_created = self.rows_created
+        self.obj.rows_updated = self.rows_updated
+        self.obj.rows_unchanged = self.rows_unchanged
+        self.obj.errors = self.errors
+        self.obj.warnings = self.warnings
+        self.obj.save(update_fields=['log_entries', 'log_info', 'rows_processed', 'rows_created', 'rows_updated',
+                                     'rows_unchanged', 'errors', 'warnings', 'status', 'fingerprinted_products'])
+
+    def _get_cleaned_data(self, rows: List[Tuple[Dict, bool]]) -> List[Dict]:
+        cleaned_data = [item for item, valid in rows if valid]
+        self.message_data = [item.get('article', 'unknown') for item, valid in rows if not valid]
         if self.message_data:
-            logger.error(f'Error: The product with articles {self.message_data} '
-                         f'will not created/updated: wrong data.')
-        if cleaned_data:
-            cleaned_data = self._get_or_create_categories(cleaned_data)
+            logger.error(f'Error: The product with articles {format_articles(self.message_data)} '
+                         f'will not created/updated: wrong data.',
+                         extra=import_extra(self.obj.pk, self.message_data))
+            self.errors += 1
         self.message_data.clear()
         return cleaned_data
 
     def _get_or_create_categories(self, cleaned_data: List[Dict]) -> List[Dict]:
-        for item in cleaned_data:
-            category, created = Category.objects.get_or_create(name=item['category'])
-            if created:
-                self.message_data.append(category.name)
-            item['category'] = category
+        """
+        Замена названий категорий на объекты, с созданием новых категорий.
+        Не больше трех запросов на пачку, независимо от числа строк
+        """
+        names = list(dict.fromkeys(item['category'] for item in cleaned_data))
+        found = Category.objects.in_bulk(names, field_name='name') if names else {}
+        self.message_data = [name for name in names if name not in found]
         if self.message_data:
-            logger.info(f'Info: New categories: {self.message_data} was created.')
-            self.message_data.clear()
+            Category.objects.bulk_create([Category(name=name) for name in self.message_data],
+                                         ignore_conflicts=True)
+            found.update(Category.objects.in_bulk(self.message_data, field_name='name'))
+            logger.info(f'Info: New categories: {format_articles(self.message_data)} was created.',
+                        extra=import_extra(self.obj.pk, [item['article'] for item in cleaned_data
+                                                         if item['category'] in self.message_data]))
+            self.message_data = []
+            categories.invalidate()
+        for item in cleaned_data:
+            item['category'] = found[item['category']]
         return cleaned_data
 
-    def create_products(self, create_data: List[Dict]) -> None:
-        cleaned_data = self._get_cleaned_data(create_data)
+    def create_products(self, cleaned_data: List[Dict]) -> None:
         Product.objects.bulk_create([Product(**item) for item in cleaned_data], batch_size=100)
+        index_products(Product.objects.filter(article__in=[item['article'] for item in cleaned_data]))
+        bump_catalog_version()
+
+    def _log_updates(self, update_data: List[Dict]) -> None:
+        articles = [item['article'] for item in update_data]
+        logger.warning(f'Warning: The product with articles {format_articles(articles)} already exists. '
+                       f'There will be updating.',
+                       extra=import_extra(self.obj.pk, articles))
+        self.warnings += 1
+
+    def upsert_products(self, cleaned_data: List[Dict]) -> None:
+        if not cleaned_data:
+            return
+        upsert_products(cleaned_data)
+        index_products(Product.objects.filter(article__in=[item['article'] for item in cleaned_data]))
+        bump_catalog_version()
 
-    def update_products(self, update_data: List[Dict]) -> None:
-        logger.warning(
-            f'Warning: The product with articles {tuple(item["article"] for item in update_data)} '
-            f'already exists. There will be updating.')
-        cleaned_data = self._get_cleaned_data(update_data)
+    def update_products(self, cleaned_data: List[Dict]) -> None:
         products = Product.objects.filter(article__in=[item['article'] for item in cleaned_data])
         cleaned_data = {item['article']: {'price': item['price'],
                                           'quantity': item['quantity'],
                                           'title': item['title'],
-                                          'category': item['category']}
+                                          'category': item['category'],
+                                          'import_fingerprint': item['import_fingerprint']}
                         for item in cleaned_data}
         for item in products:
             item.price = cleaned_data[item.article]['price']
             item.quantity = cleaned_data[item.article]['quantity']
             item.title = cleaned_data[item.article]['title']
             item.category = cleaned_data[item.article]['category']
-        Product.objects.bulk_update(products, ['price', 'quantity', 'title', 'category'], batch_size=100)
+            item.import_fingerprint = cleaned_data[item.article]['import_fingerprint']
+        Product.objects.bulk_update(products, ['price', 'quantity', 'title', 'category', 'import_fingerprint'],
+                                    batch_size=100)
+        index_products(products)
+        bump_catalog_version()
+
+
+def claim_import() -> Optional[ProductImportFile]:
+    """
+    Take the oldest queued import. The status is switched by a conditional update,
+    so concurrent workers never take the same import.
+    Imports in progress without a heartbeat for IMPORT_STALE_TIMEOUT were left by a crashed worker
+    and are queued again first.
+    """
+    stale = timezone.now() - timedelta(seconds=settings.IMPORT_STALE_TIMEOUT)
+    ProductImportFile.objects.filter(Q(heartbeat_at__lt=stale) | Q(heartbeat_at__isnull=True),
+                                     status=ProductImportFile.IN_PROGRESS)\
+                             .update(status=ProductImportFile.QUEUED)
+    queued = ProductImportFile.objects.filter(status=ProductImportFile.QUEUED)
+    for pk in queued.order_by('id').values_list('id', flat=True)[:10]:
+        if queued.filter(pk=pk).update(status=ProductImportFile.IN_PROGRESS, heartbeat_at=timezone.now()):
+            return ProductImportFile.objects.get(pk=pk)
+    return None
+
+
+def run_import(obj: ProductImportFile) -> bool:
+    imp = Import(obj)
+    try:
+        obj.rows_total, obj.file_hash = imp.scan_file()
+        obj.save(update_fields=['rows_total', 'file_hash'])
+        if not obj.dry_run and imp.is_repeated_file():
+            logger.info(f'Info: {obj.file} is the same as the last imported file, skipped.')
+            ProductImportFile.objects.filter(pk=obj.pk).update(status=ProductImportFile.SKIPPED,
+                                                               log_info='The same file was imported last time.')
+            return True
+        return imp.import_data()
+    except Exception:
+        with imp.collect_logs():
+            logger.exception(f'Error: {obj.file} import failed', extra=import_extra(obj.pk))
+        imp.errors += 1
+    imp.fail()
+    return False
 
 
 def get_report_purchases():
-    purchases = Purchase.objects.select_related('product', 'order')\
-                                .all()\
-                                .values('purchase_date', 'product__title', 'qty', 'product__price')\
-                                .order_by('-purchase_date')
+    """
+    Quantity and revenue of the purchases by day and product, from the prices and titles saved in the purchases:
+    the query reads only the purchases table and groups them along its purchase_report index.
+    Purchases not filled by backfill_purchase_prices yet are counted at the current product price and title.
+    """
+    purchases = list(Purchase.objects.values('purchase_date', 'product')
+                                     .annotate(quantity=Sum('qty'),
+                                               revenue=Sum(F('qty') * F('unit_price'), output_field=DecimalField()),
+                                               unpriced=Count('qty', filter=Q(unit_price__isnull=True)),
+                                               title=Max('title'))
+                                     .order_by('-purchase_date', '-product'))
+    if any(item['unpriced'] for item in purchases):
+        unpriced = Purchase.objects.filter(unit_price__isnull=True)\
+                                   .values('purchase_date', 'product')\
+                                   .annotate(revenue=Sum(F('qty') * F('product__price'), output_field=DecimalField()),
+                                             title=Max('product__title'))
+        unpriced = {(item['purchase_date'], item['product']): item for item in unpriced}
+        for item in purchases:
+            current = unpriced.get((item['purchase_date'], item['product']))
+            if item['unpriced'] and current:
+                item['revenue'] = (item['revenue'] or 0) + current['revenue']
+                item['title'] = item['title'] or current['title']
     result = {}
-    for item in list(purchases):
-        key = str(item['purchase_date'])
-        temp = {item['product__title']:
-            {
-                'price': item['product__price'], 'quantity': item['qty']
-        }
-        }
-        if not result.get(key):
-            result[key] = temp
-        else:
-            if item['product__title'] in result[key].keys():
-                result[key][item['product__title']]['quantity'] += item['qty']
-            else:
-                result[key][item['product__title']] = temp[item['product__title']]
+    for item in purchases:
+        day = result.setdefault(str(item['purchase_date']), {})
+        product = day.setdefault(item['title'], {'price': Decimal(0), 'quantity': 0, 'revenue': Decimal(0)})
+        product['quantity'] += item['quantity']
+        product['revenue'] += item['revenue'] or 0
+        if product['quantity']:
+            # the average price, if the price changed during the day
+            product['price'] = (product['revenue'] / product['quantity']).quantize(Decimal('0.01'))
     total = 0
     for item in result.values():
-        temp = [(x['quantity'], x['price']) for x in list(item.values())]
-        item['summary quantity'] = sum([x[0] for x in temp])
-        item['summary profit'] = sum([x[0]*x[1] for x in temp])
+        products = list(item.values())
+        item['summary quantity'] = sum(x['quantity'] for x in products)
+        item['summary profit'] = sum(x.pop('revenue') for x in products)
         total += item['summary profit']
-    return result, total
\ No newline at end of file
+    return result, total
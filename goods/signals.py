@@ -0,0 +1,46 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from goods.cache import bump_catalog_version, bump_prices_version, categories
+from goods.models import Category, Product
+from goods.search import index_products
+
+
+@receiver(pre_save, sender=Product)
+def product_fingerprint_handler(sender, **kwargs) -> None:
+    # the product may differ from the imported row now, so the next import must write it
+    kwargs['instance'].import_fingerprint = ''
+
+
+@receiver(pre_save, sender=Product)
+def product_price_handler(sender, **kwargs) -> None:
+    product = kwargs['instance']
+    if product.pk is None:
+        return
+    if Product.objects.filter(pk=product.pk).exclude(price=product.price).exists():
+        bump_prices_version()
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted_handler(sender, **kwargs) -> None:
+    # the product is deleted from the carts as well
+    bump_prices_version()
+
+
+@receiver(post_save, sender=Product)
+def product_search_index_handler(sender, **kwargs) -> None:
+    index_products(Product.objects.filter(pk=kwargs['instance'].pk))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def catalog_changed_handler(sender, **kwargs) -> None:
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed_handler(sender, **kwargs) -> None:
+    categories.invalidate()
@@ -0,0 +1,84 @@
+"""
+Sharded stock of hot products. The stock of a product with `stock_shards` > 0 is its quantity
+plus the quantity of its ProductStockShard rows: a write-off decrements one random shard,
+so concurrent checkouts of the product lock different rows.
+"""
+from typing import Iterable
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, OuterRef, Subquery, Sum, When
+from django.db.models.functions import Coalesce
+
+from goods.models import Product, ProductStockShard
+
+# attempts to take the write-off from a random shard before looking at the whole stock
+WRITE_OFF_ATTEMPTS = 3
+
+
+def stock_quantity() -> Case:
+    """
+    Expression of the stock of a product, for annotations and values()
+    """
+    shards = ProductStockShard.objects.filter(product=OuterRef('pk'))\
+                                      .values('product')\
+                                      .annotate(total=Sum('quantity'))\
+                                      .values('total')
+    return Case(When(stock_shards=0, then=F('quantity')),
+                default=F('quantity') + Coalesce(Subquery(shards, output_field=IntegerField()), 0),
+                output_field=IntegerField())
+
+
+def distribute_stock(product_ids: Iterable[int]) -> None:
+    """
+    The quantity just written to the products (by import or by the admin) is their whole stock:
+    split it evenly between the shards of the sharded ones, drop the shards of the others
+    """
+    with transaction.atomic():
+        products = Product.objects.select_for_update()\
+                                  .filter(pk__in=list(product_ids))\
+                                  .values_list('pk', 'quantity', 'stock_shards')
+        for product_id, quantity, shards in products:
+            ProductStockShard.objects.filter(product_id=product_id).delete()
+            if not shards:
+                continue
+            size, rest = divmod(max(quantity, 0), shards)
+            ProductStockShard.objects.bulk_create([
+                ProductStockShard(product_id=product_id, number=number, quantity=size + (number < rest))
+                for number in range(shards)])
+            Product.objects.filter(pk=product_id).update(quantity=0)
+
+
+def write_off_sharded(product_id: int, qty: int) -> bool:
+    """
+    Take `qty` from a random shard which has enough, then from the product row.
+    Only when neither has enough, the product and all its shards are locked and the stock is taken from several.
+    """
+    candidates = ProductStockShard.objects.filter(product_id=product_id, quantity__gte=qty).order_by('?')
+    for _ in range(WRITE_OFF_ATTEMPTS):
+        # the shard may be emptied by another checkout after it was chosen, so the condition is checked again
+        updated = ProductStockShard.objects.filter(pk=Subquery(candidates.values('pk')[:1]), quantity__gte=qty)\
+                                           .update(quantity=F('quantity') - qty)
+        if updated:
+            return True
+        # no shard has enough any more, retrying is pointless
+        if not candidates.exists():
+            break
+    if Product.objects.filter(pk=product_id, quantity__gte=qty).update(quantity=F('quantity') - qty):
+        return True
+    return _write_off_locked(product_id, qty)
+
+
+def _write_off_locked(product_id: int, qty: int) -> bool:
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(pk=product_id)
+        shards = list(ProductStockShard.objects.select_for_update().filter(product_id=product_id).order_by('number'))
+        if product.quantity + sum(shard.quantity for shard in shards) < qty:
+            return False
+        for shard in shards:
+            taken = min(max(shard.quantity, 0), qty)
+            shard.quantity -= taken
+            qty -= taken
+        ProductStockShard.objects.bulk_update(shards, ['quantity'])
+        if qty:
+            Product.objects.filter(pk=product_id).update(quantity=F('quantity') - qty)
+    return True
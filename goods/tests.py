@@ -1,3 +1,689 @@
-from django.test import TestCase
+import bz2
+import gzip
+import io
+import json
+import logging
+import lzma
+import tempfile
+import threading
+import time
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.http import Http404
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from goods.cache import CATALOG_MODIFIED_KEY, categories, get_or_build, get_prices_version
+from goods.logs import ImportLogCollector, import_extra
+from goods.models import Product, Category, ProductImportFile
+from goods.parsing import split_records
+from goods.search import index_products
+from goods.serializers import FastProductSerializer, ProductSerializer
+from goods.services import Import, claim_import, get_products, run_import
+
+
+class ProductApiTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='test_category')
+        cls.other_category = Category.objects.create(name='other_category')
+        Product.objects.bulk_create([Product(title=f'test_product_{i}', article=f'art{i}', price=100 + i,
+                                             quantity=i, category=cls.category) for i in range(20)])
+        Product.objects.bulk_create([Product(title=f'other_product_{i}', article=f'oth{i}', price=50,
+                                             quantity=1, category=cls.other_category) for i in range(5)])
+        index_products(Product.objects.all())
+
+    def setUp(self):
+        cache.clear()
+
+    def _walk_cursor_pages(self, url: str) -> list:
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def test_offset_pagination_by_default(self):
+        """Старые клиенты получают limit/offset пагинацию с общим количеством"""
+        response = self.client.get('/api/products/', {'offset': 8, 'limit': 8})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual(len(response.data['results']), 8)
+
+    def test_cursor_pagination(self):
+        """Курсорная пагинация проходит весь каталог без повторов и без подсчета"""
+        response = self.client.get('/api/products/', {'pagination': 'cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('count', response.data)
+        ids = self._walk_cursor_pages('/api/products/?pagination=cursor&limit=7')
+        self.assertEqual(ids, sorted(Product.objects.values_list('id', flat=True)))
+
+    def test_cursor_pagination_with_filters(self):
+        """Курсорная пагинация сохраняет фильтры по категории и поиску"""
+        ids = self._walk_cursor_pages(f'/api/products/?pagination=cursor&limit=3'
+                                      f'&category_id={self.other_category.id}')
+        self.assertEqual(len(ids), 5)
+        ids = self._walk_cursor_pages('/api/products/?pagination=cursor&limit=3'
+                                      '&category=test_category&search=product_1')
+        self.assertEqual(len(ids), 11)
+
+    def test_cache_by_scheme(self):
+        """Закэшированная страница не отдает ссылки пагинации с другой схемой"""
+        self.client.get('/api/products/', {'limit': 5})
+        response = self.client.get('/api/products/', {'limit': 5}, secure=True)
+        self.assertTrue(response.data['next'].startswith('https://testserver/'))
+
+    def test_wrong_pagination_mode(self):
+        """Неизвестный режим пагинации отклоняется"""
+        response = self.client.get('/api/products/', {'pagination': 'pages'})
+        self.assertEqual(response.status_code, 405)
+
+
+class ProductSearchTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='test_category')
+        for title, article in [('Red phone case', 'a1'), ('Phone', 'a2'), ('Blue laptop bag', 'a3'),
+                               ('Laptop', 'phone1'), ('Чехол для ноутбука', 'a4')]:
+            Product.objects.create(title=title, article=article, price=10, quantity=1, category=category)
+
+    def setUp(self):
+        cache.clear()
+
+    def _search(self, query: str) -> list:
+        response = self.client.get('/api/products/', {'search': query})
+        self.assertEqual(response.status_code, 200)
+        return [item['title'] for item in response.data['results']]
+
+    def test_prefix_search(self):
+        """Поиск по префиксам слов названия и артикула"""
+        self.assertEqual(set(self._search('lap')), {'Blue laptop bag', 'Laptop'})
+        self.assertEqual(self._search('case red'), ['Red phone case'])
+        self.assertEqual(self._search('missing'), [])
+        self.assertEqual(self._search('Ноут'), ['Чехол для ноутбука'])
+
+    def test_relevance_ordering(self):
+        """Точные совпадения слов выше совпадений по префиксу"""
+        self.assertEqual(self._search('phone'), ['Red phone case', 'Phone', 'Laptop'])
+
+    def test_index_updated_on_save(self):
+        """Индекс обновляется при изменении товара"""
+        product = Product.objects.get(article='a2')
+        product.title = 'Smartwatch'
+        product.save()
+        self.assertEqual(self._search('smart'), ['Smartwatch'])
+        self.assertNotIn('Phone', self._search('phone'))
+
+
+class ProductCacheTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='test_category')
+        cls.product = Product.objects.create(title='test', article='123we', price=123,
+                                             quantity=1, category=cls.category)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_list_is_cached(self):
+        """Повторный запрос списка не обращается к базе"""
+        self.client.get('/api/products/', {'category_id': self.category.id})
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/products/', {'category_id': self.category.id})
+        self.assertEqual(response.data['count'], 1)
+
+    def test_cache_invalidated_on_save(self):
+        """Изменение товара сбрасывает кэш"""
+        self.client.get('/api/products/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = 200
+            self.product.save()
+        response = self.client.get('/api/products/')
+        self.assertEqual(response.data['results'][0]['price'], '200.00')
+
+    def test_wrong_params_not_cached(self):
+        """Неверные параметры отклоняются и при наличии кэша"""
+        self.client.get('/api/products/')
+        response = self.client.get('/api/products/', {'page': 2})
+        self.assertEqual(response.status_code, 405)
+
+    def test_single_flight(self):
+        """При одновременных промахах кэша значение строится один раз"""
+        calls = []
+
+        def build():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_or_build('test-key', build)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 5)
+
+    def test_conditional_get(self):
+        """Запрос с совпадающим ETag получает 304 без обращения к базе"""
+        cache.set(CATALOG_MODIFIED_KEY, timezone.now() - timedelta(minutes=1), timeout=None)
+        response = self.client.get('/api/products/')
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/api/products/', {'category_id': self.category.id},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_conditional_get_index(self):
+        """Главная страница для анонимных пользователей поддерживает If-Modified-Since"""
+        cache.set(CATALOG_MODIFIED_KEY, timezone.now() - timedelta(minutes=1), timeout=None)
+        response = self.client.get('/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_last_modified_current_second(self):
+        """Изменение каталога в текущую секунду не отдаёт Last-Modified, остаётся только ETag"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        response = self.client.get('/api/products/')
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertTrue(response.has_header('ETag'))
+
+
+class FastProductSerializerTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        categories = [Category.objects.create(name=f'category_{i}') for i in range(5)]
+        Product.objects.bulk_create([Product(title=f'product "{i}"', article=f'{i}', price=f'{i}.5',
+                                             quantity=i, category=categories[i % 5])
+                                     for i in range(100)])
+
+    def _render(self, serializer_class, queryset) -> bytes:
+        return JSONRenderer().render(serializer_class(queryset, many=True).data)
+
+    def test_same_output(self):
+        """Быстрый сериализатор выдает тот же JSON, что и ProductSerializer"""
+        queryset = get_products().order_by('id')[:100]
+        fast_queryset = queryset.values(*FastProductSerializer.value_fields)
+        self.assertEqual(self._render(ProductSerializer, queryset),
+                         self._render(FastProductSerializer, fast_queryset))
+        product = queryset[0]
+        self.assertEqual(ProductSerializer(product).data, FastProductSerializer(product).data)
+
+
+class CategoryMapTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='test_category')
+        Product.objects.create(title='test', article='123we', price=123, quantity=1, category=cls.category)
+
+    def setUp(self):
+        cache.clear()
+        categories.load()
+
+    def test_one_query(self):
+        """Фильтр по категории выполняется одним запросом"""
+        with self.assertNumQueries(1):
+            self.assertEqual(len(get_products(category_name='test_category')), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(get_products(category_id=str(self.category.id))), 1)
+
+    def test_unknown_category(self):
+        """Для неизвестной категории по-прежнему 404"""
+        with self.assertRaises(Http404):
+            get_products(category_name='unknown')
+        with self.assertRaises(Http404):
+            get_products(category_id='abc')
+        response = self.client.get('/api/products/', {'category_id': 999})
+        self.assertEqual(response.status_code, 404)
+
+    def test_new_category(self):
+        """Новая категория доступна после сохранения"""
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name='new_category')
+        self.assertEqual(len(get_products(category_name='new_category')), 0)
+
+
+class ProductExportTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='test_category')
+        other_category = Category.objects.create(name='other_category')
+        Product.objects.create(title='test, "quoted"', article='123we', price=123, quantity=1,
+                               category=cls.category)
+        Product.objects.create(title='other', article='321', price='10.50', quantity=5,
+                               category=other_category)
+
+    def _export(self, **params) -> bytes:
+        response = self.client.get('/api/products/export/', params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_csv(self):
+        """Выгрузка в csv с колонками файла импорта"""
+        content = self._export().decode()
+        self.assertEqual(content.splitlines(), ['title,article,price,quantity,category',
+                                                '"test, ""quoted""",123we,123.00,1,test_category',
+                                                'other,321,10.50,5,other_category'])
+
+    def test_ndjson_gzip_with_filter(self):
+        """Выгрузка NDJSON со сжатием и фильтром по категории"""
+        content = gzip.decompress(self._export(output='ndjson', gzip=1, category_id=self.category.id))
+        self.assertEqual([json.loads(line) for line in content.splitlines()],
+                         [{'title': 'test, "quoted"', 'article': '123we', 'price': '123.00',
+                           'quantity': 1, 'category': 'test_category'}])
+
+    def test_wrong_params(self):
+        """Неизвестный формат выгрузки отклоняется"""
+        response = self.client.get('/api/products/export/', {'output': 'xml'})
+        self.assertEqual(response.status_code, 405)
+
+
+class IndexViewTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='test_category')
+        other_category = Category.objects.create(name='other_category')
+        Product.objects.bulk_create([Product(title=f'test_product_{i}', article=f'art{i}', price=100,
+                                             quantity=1, category=cls.category) for i in range(30)])
+        Product.objects.create(title='other_product', article='oth', price=50, quantity=1,
+                               category=other_category)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_pagination(self):
+        """Главная страница разбита на страницы и фильтруется по категории"""
+        response = self.client.get('/')
+        self.assertEqual(len(response.context['products']), 24)
+        response = self.client.get('/', {'page': 2})
+        self.assertEqual(len(response.context['products']), 7)
+        response = self.client.get('/', {'category': 'other_category'})
+        self.assertContains(response, 'other_product')
+        self.assertNotContains(response, 'test_product_0<')
+        self.assertEqual(self.client.get('/', {'category': 'unknown'}).status_code, 404)
+
+    def test_grid_cached(self):
+        """Повторный рендер страницы не обращается к базе, изменения каталога сбрасывают кэш"""
+        self.client.get('/', {'page': 2})
+        with self.assertNumQueries(0):
+            response = self.client.get('/', {'page': 2})
+        self.assertContains(response, 'test_product_29')
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(article='art29').update(title='renamed_product')
+            Product.objects.get(article='art29').save()
+        response = self.client.get('/', {'page': 2})
+        self.assertContains(response, 'renamed_product')
+
+
+class ProductBatchTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='test_category')
+        cls.products = [Product.objects.create(title=f'test_{i}', article=f'art{i}', price=10, quantity=1,
+                                               category=category) for i in range(3)]
+
+    def test_batch_by_ids(self):
+        """Товары по списку id одним запросом, с перечислением ненайденных"""
+        ids = [self.products[2].id, 999, self.products[0].id]
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/products/batch/', {'ids': ','.join(map(str, ids))})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.data['results']], [ids[0], ids[2]])
+        self.assertEqual(response.data['missing'], [999])
+
+    def test_batch_by_articles(self):
+        """Товары по списку артикулов в теле запроса"""
+        response = self.client.post('/api/products/batch/', {'articles': ['art1', 'unknown']},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['article'] for item in response.data['results']], ['art1'])
+        self.assertEqual(response.data['missing'], ['unknown'])
+
+    def test_batch_wrong_params(self):
+        """Некорректные запросы отклоняются"""
+        self.assertEqual(self.client.get('/api/products/batch/').status_code, 400)
+        self.assertEqual(self.client.get('/api/products/batch/', {'ids': 'a,b'}).status_code, 400)
+        response = self.client.post('/api/products/batch/', {'ids': list(range(101))},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMPORT_BATCH_SIZE=2)
+class ImportTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='some_category')
+        Product.objects.create(title='old', article='321334', price=1, quantity=1, category=category)
+
+    def _import(self, content: bytes) -> ProductImportFile:
+        obj = ProductImportFile.objects.create(file=SimpleUploadedFile('products.csv', content))
+        with self.captureOnCommitCallbacks(execute=True):
+            Import(obj).import_data()
+        return obj
+
+    def test_import(self):
+        """Импорт создает новые товары и обновляет существующие, пропуская строки с ошибками"""
+        obj = self._import('\ufefftitle,article,price,quantity,category\r\n'
+                     'product_1,321334,123,3,some_category\r\n'
+                     'product_2,124322,223,12,some_category_2\r\n'
+                     '"product, 3",432345,333,34,some_category\r\n'
+                     'product_4,523423,sda3,34,some_category_3\r\n'
+                     'product_5,432516\r\n'.encode())
+        self.assertEqual(Product.objects.count(), 3)
+        product = Product.objects.get(article='321334')
+        self.assertEqual((product.title, product.price, product.quantity), ('product_1', 123, 3))
+        self.assertEqual(Product.objects.get(article='432345').title, 'product, 3')
+        self.assertEqual(Category.objects.get(name='some_category_2').products.count(), 1)
+        self.assertEqual((obj.errors, obj.warnings, obj.rows_processed), (2, 1, 5))
+        errors = [entry for entry in obj.log_entries if entry['level'] == 'ERROR']
+        self.assertEqual([(entry['count'], entry['articles']) for entry in errors],
+                         [(1, ['523423']), (1, ['432516'])])
+        self.assertIn('some_category_2', obj.log_info)
+        self.assertIn('finished importing', obj.log_info)
+
+    @override_settings(IMPORT_BATCH_SIZE=100)
+    def test_long_article_list(self):
+        """Сообщение лога показывает только первые артикулы, полный список остается в записи"""
+        obj = self._import(('title,article,price,quantity,category\n' +
+                            ''.join(f'bad,{i},x,1,c\n' for i in range(15))).encode())
+        entry = next(entry for entry in obj.log_entries if entry['level'] == 'ERROR')
+        self.assertEqual(entry['count'], 15)
+        self.assertIn('(0, 1, 2, 3, 4, 5, 6, 7, 8, 9, ... 5 more)', entry['message'])
+        self.assertNotIn('14', entry['message'])
+
+    def test_repeated_article(self):
+        """Повторяющийся артикул импортируется из последней строки"""
+        self._import(b'title,article,price,quantity,category\n'
+                     b'first,111,1,1,some_category\nsecond,111,2,2,some_category\n')
+        self.assertEqual(Product.objects.get(article='111').title, 'second')
+
+    @override_settings(IMPORT_BATCH_SIZE=1000)
+    def test_categories_resolved_per_batch(self):
+        """Число запросов к категориям не зависит от числа строк пачки"""
+        def count_category_queries(rows: int) -> int:
+            content = 'title,article,price,quantity,category\n' + ''.join(
+                f'p{rows}_{i},a{rows}_{i},1,1,c{rows}_{i % 5}\n' for i in range(rows))
+            with CaptureQueriesContext(connection) as queries:
+                self._import(content.encode())
+            return sum('"categories"' in query['sql'] for query in queries.captured_queries)
+
+        self.assertEqual(count_category_queries(10), count_category_queries(100))
+        self.assertEqual(Category.objects.filter(name__startswith='c100_').count(), 5)
+
+    def test_unchanged_rows_not_written(self):
+        """Повторный импорт не пишет строки, совпадающие с прошлым импортом"""
+        content = b'title,article,price,quantity,category\nfirst,1,1,1,c\nsecond,2,2,2,c\nthird,3,3,3,c\n'
+        self._import(content)
+        product = Product.objects.get(article='2')
+        product.quantity = 0
+        product.save()
+        with CaptureQueriesContext(connection) as queries:
+            obj = self._import(content)
+        self.assertEqual((obj.rows_created, obj.rows_updated, obj.rows_unchanged), (0, 1, 2))
+        self.assertEqual(Product.objects.get(article='2').quantity, 2)
+        written = ' '.join(query['sql'] for query in queries.captured_queries
+                           if query['sql'].startswith(('INSERT INTO "products"', 'UPDATE "products"')))
+        self.assertIn("'second'", written)
+        self.assertNotIn("'first'", written)
+        self.assertNotIn("'third'", written)
+
+    def test_prices_version(self):
+        """Итоги корзин сбрасываются импортом, только если он меняет цены"""
+        version = get_prices_version()
+        self._import(b'title,article,price,quantity,category\nold,321334,1,5,some_category\n')
+        self.assertEqual(get_prices_version(), version)
+        self._import(b'title,article,price,quantity,category\nold,321334,2,5,some_category\n')
+        self.assertNotEqual(get_prices_version(), version)
+
+    def test_dry_run(self):
+        """Пробный импорт только считает новые, измененные и неизмененные товары"""
+        obj = ProductImportFile.objects.create(file=SimpleUploadedFile('products.csv', (
+            b'title,article,price,quantity,category\nold,321334,1,1,some_category\nnew,1,1,1,new_category\n')),
+            dry_run=True)
+        Import(obj).import_data()
+        self.assertEqual((obj.rows_created, obj.rows_updated, obj.rows_unchanged), (1, 1, 0))
+        self.assertFalse(Product.objects.filter(article='1').exists())
+        self.assertFalse(Category.objects.filter(name='new_category').exists())
+
+    @override_settings(IMPORT_BATCH_SIZE=1)
+    def test_dry_run_repeated_article(self):
+        """Артикул, повторенный в разных пачках, пробный импорт считает так же, как настоящий"""
+        content = (b'title,article,price,quantity,category\nnew,1,1,1,c\nnew,1,1,1,c\n'
+                   b'changed,1,1,1,c\nold,321334,1,1,some_category\nold,321334,1,1,some_category\n')
+        dry_run = ProductImportFile.objects.create(file=SimpleUploadedFile('products.csv', content), dry_run=True)
+        Import(dry_run).import_data()
+        obj = self._import(content)
+        self.assertEqual((dry_run.rows_created, dry_run.rows_updated, dry_run.rows_unchanged), (1, 2, 2))
+        self.assertEqual((obj.rows_created, obj.rows_updated, obj.rows_unchanged), (1, 2, 2))
+
+    def test_log_of_one_import(self):
+        """Лог импорта содержит только его записи и ограничен по размеру"""
+        collector = ImportLogCollector(1, max_entries=2, max_articles=2)
+        logger = logging.getLogger('goods.services')
+        logger.addHandler(collector)
+        try:
+            for i in range(3):
+                logger.warning(f'first {i}', extra=import_extra(1, ['a', 'b', 'c']))
+            logger.warning('second', extra=import_extra(2, ['d']))
+        finally:
+            logger.removeHandler(collector)
+        self.assertEqual(collector.get_entries(), [{'level': 'WARNING', 'message': f'first {i}', 'count': 3,
+                                                     'articles': ['a', 'b']} for i in (1, 2)])
+        self.assertEqual(collector.dropped, 1)
+
+    def test_compressed_and_ndjson(self):
+        """Сжатые файлы и ndjson распознаются по содержимому и проверяются по тем же правилам"""
+        csv_content = b'title,article,price,quantity,category\ngz,1,1,1,some_category\n'
+        ndjson_content = (b'{"title": "bz", "article": 2, "price": 2, "quantity": 2, "category": "some_category"}\n'
+                          b'not json\n\n'
+                          b'{"title": "xz", "article": "3", "price": "3", "quantity": 3, "category": "new"}\n')
+        obj = self._import(gzip.compress(csv_content))
+        self.assertEqual((obj.rows_created, obj.errors), (1, 0))
+        obj = self._import(bz2.compress(ndjson_content))
+        self.assertEqual((obj.rows_created, obj.errors), (2, 1))
+        self.assertEqual(Product.objects.get(article='2').price, 2)
+        self.assertEqual(Product.objects.get(article='3').category.name, 'new')
+        # an invalid row of the first batch and the truncated file
+        obj = self._import(lzma.compress(ndjson_content)[:-10])
+        self.assertEqual(obj.errors, 2)
+        self.assertNotEqual(obj.status, ProductImportFile.COMPLETE)
+
+    def test_not_valid_import(self):
+        """Файл не в utf-8 не импортируется"""
+        self.assertFalse(Import(ProductImportFile.objects.create(
+            file=SimpleUploadedFile('products.csv', 'title\nтовар'.encode('cp1251')))).import_data())
+
+
+@override_settings(IMPORT_UPSERT=False)
+class TwoPhaseImportTestCase(ImportTestCase):
+    """Те же проверки для импорта через bulk_create/bulk_update"""
+
+
+@override_settings(IMPORT_WORKERS=2, IMPORT_CHUNK_BYTES=16)
+class ParallelImportTestCase(ImportTestCase):
+    """Те же проверки для разбора файла в нескольких процессах"""
+
+    def test_split_records(self):
+        """Файл делится только по концам записей, перевод строки в кавычках не разделяет запись"""
+        content = b'title,article\n"multi\nline, title",1\nshort,2\n"a ""quoted\n"" one",3\nlast,4'
+        offsets = list(split_records(io.BytesIO(content), chunk_size=1, block_size=7))
+        records = [content[start:end] for start, end in zip(offsets, offsets[1:] + [len(content)])]
+        self.assertEqual(offsets[0], len(b'title,article\n'))
+        self.assertEqual(records, [b'"multi\nline, title",1\n', b'short,2\n', b'"a ""quoted\n"" one",3\n',
+                                   b'last,4'])
+
+    def test_literal_quote(self):
+        """Кавычка внутри поля без кавычек не ломает разбор файла на части"""
+        content = ('title,article,price,quantity,category\n'
+                   'monitor 27" wide,1,100,1,c\n'
+                   '"multi\nline",2,100,1,c\n'
+                   'product_3,3,100,1,c\n'
+                   'monitor 32" wide,4,100,1,c\n'
+                   '"multi\nline 2",5,100,1,c\n')
+        self.assertEqual(self._import(content.encode()).status, ProductImportFile.COMPLETE)
+        self.assertEqual(dict(Product.objects.exclude(article='321334').values_list('article', 'title')),
+                         {'1': 'monitor 27" wide', '2': 'multi\nline', '3': 'product_3',
+                          '4': 'monitor 32" wide', '5': 'multi\nline 2'})
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMPORT_BATCH_SIZE=2)
+class ImportJobTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(email='admin@user.com', password='testp@sw0rd')
+
+    def test_queued_import(self):
+        """Импорт из админки ставится в очередь и выполняется воркером"""
+        self.client.login(email='admin@user.com', password='testp@sw0rd')
+        content = b'title,article,price,quantity,category\nproduct_1,1,123,3,c\nproduct_2,2,1,1,c\nbad,3,x,1,c\n'
+        response = self.client.post('/products/import/', {'file': SimpleUploadedFile('products.csv', content)})
+        self.assertEqual(response.status_code, 302)
+        obj = ProductImportFile.objects.get()
+        self.assertEqual(obj.status, ProductImportFile.QUEUED)
+        self.assertEqual(Product.objects.count(), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_worker', '--once', stdout=io.StringIO())
+        self.assertEqual(Product.objects.count(), 2)
+        response = self.client.get(f'/products/import/{obj.pk}/status/')
+        self.assertEqual(response.json(), {'file': str(obj.file), 'status': ProductImportFile.COMPLETE,
+                                           'rows_processed': 3, 'rows_total': 3, 'dry_run': False,
+                                           'rows_created': 2, 'rows_updated': 0, 'rows_unchanged': 0,
+                                           'errors': 1, 'warnings': 0})
+
+    def test_stale_import_requeued(self):
+        """Импорт, брошенный упавшим воркером, снова берется из очереди, а выполняющийся — нет"""
+        content = b'title,article,price,quantity,category\nproduct_1,1,123,3,c\n'
+        running, stale = [ProductImportFile.objects.create(file=SimpleUploadedFile('products.csv', content),
+                                                           status=ProductImportFile.IN_PROGRESS,
+                                                           heartbeat_at=timezone.now() - timedelta(seconds=age))
+                          for age in (10, 3600)]
+        self.assertEqual(claim_import(), stale)
+        self.assertIsNone(claim_import())
+        running.refresh_from_db()
+        self.assertEqual(running.status, ProductImportFile.IN_PROGRESS)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, ProductImportFile.IN_PROGRESS)
+        self.assertGreater(stale.heartbeat_at, timezone.now() - timedelta(seconds=10))
+
+    @override_settings(IMPORT_BATCH_SIZE=100)
+    def test_partial_import(self):
+        """Пачки, записанные до ошибки в середине файла, остаются, а импорт помечается частично выполненным"""
+        content = 'title,article,price,quantity,category\n' + ''.join(
+            f'product_{i},{i},1,1,c\n' for i in range(1000))
+        obj = ProductImportFile.objects.create(
+            file=SimpleUploadedFile('products.csv', content.encode() + b'\xff\xfe,broken\n'))
+        self.assertFalse(run_import(obj))
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, ProductImportFile.PARTIAL)
+        self.assertGreater(obj.rows_created, 0)
+        self.assertEqual(obj.rows_created, Product.objects.count())
+        self.assertIn(f'{obj.rows_created} created and 0 updated products are kept', obj.log_info)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_repeated_file_skipped(self):
+        """Файл, совпадающий с последним импортированным, пропускается целиком"""
+        content = b'title,article,price,quantity,category\nproduct_1,1,123,3,c\n'
+        first, second = [ProductImportFile.objects.create(file=SimpleUploadedFile('products.csv', content))
+                         for _ in range(2)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(run_import(first))
+            self.assertTrue(run_import(second))
+        second.refresh_from_db()
+        self.assertEqual(second.status, ProductImportFile.SKIPPED)
+        self.assertEqual(second.file_hash, ProductImportFile.objects.get(pk=first.pk).file_hash)
+
+    @override_settings(IMPORT_BATCH_SIZE=100)
+    def test_repeated_file_after_partial_import(self):
+        """Файл после частично выполненного импорта другого файла импортируется заново"""
+        header = 'title,article,price,quantity,category\n'
+        content = (header + ''.join(f'product_{i},{i},10,3,c\n' for i in range(1000))).encode()
+        broken = (header + ''.join(f'product_{i},{i},1,1,c\n' for i in range(1000))).encode() + b'\xff\xfe,x\n'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(run_import(ProductImportFile.objects.create(
+                file=SimpleUploadedFile('products.csv', content))))
+            partial = ProductImportFile.objects.create(file=SimpleUploadedFile('products.csv', broken))
+            self.assertFalse(run_import(partial))
+            again = ProductImportFile.objects.create(file=SimpleUploadedFile('products.csv', content))
+            self.assertTrue(run_import(again))
+        self.assertEqual(ProductImportFile.objects.get(pk=partial.pk).status, ProductImportFile.PARTIAL)
+        again.refresh_from_db()
+        self.assertEqual(again.status, ProductImportFile.COMPLETE)
+        self.assertGreater(again.rows_updated, 0)
+        self.assertEqual(set(Product.objects.values_list('price', 'quantity')), {(10, 3)})
+
+    def test_crashed_batch(self):
+        """Ошибка при записи пачки видна в логе импорта и в счетчике ошибок"""
+        content = b'title,article,price,quantity,category\nproduct_1,1,123456789012345678901234567890,3,c\n'
+        obj = ProductImportFile.objects.create(file=SimpleUploadedFile('products.csv', content))
+        self.assertFalse(run_import(obj))
+        obj.refresh_from_db()
+        self.assertEqual((obj.status, obj.errors), (ProductImportFile.FAILED, 1))
+        self.assertIn('import failed', obj.log_info)
+        self.assertEqual(obj.log_entries[-1]['level'], 'ERROR')
+
+    def test_repeated_file_after_product_change(self):
+        """Файл не пропускается, если импортированный им товар изменен после импорта"""
+        content = b'title,article,price,quantity,category\nproduct_1,1,123,3,c\n'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(run_import(ProductImportFile.objects.create(
+                file=SimpleUploadedFile('products.csv', content))))
+            product = Product.objects.get(article='1')
+            product.quantity = 0
+            product.save()
+            again = ProductImportFile.objects.create(file=SimpleUploadedFile('products.csv', content))
+            self.assertTrue(run_import(again))
+        again.refresh_from_db()
+        self.assertEqual((again.status, again.rows_updated), (ProductImportFile.COMPLETE, 1))
+        self.assertEqual(Product.objects.get(article='1').quantity, 3)
+
+    def test_benchmark_import(self):
+        """Бенчмарк импорта выдает результаты по фазам в json"""
+        output = io.StringIO()
+        call_command('benchmark_import', '--sizes', '50', '--modes', 'two-phase', '--batch-size', '20',
+                     '--json', '-', '--memory', stdout=output)
+        result, = json.loads(output.getvalue())
+        self.assertEqual((result['rows'], result['mode']), (50, 'two-phase'))
+        self.assertEqual(set(result['phases']), {'parse', 'categories', 'create', 'update', 'upsert', 'log', 'other'})
+        self.assertGreater(result['phases']['create']['queries'], 0)
+        create = result['phases']['create']
+        self.assertGreaterEqual(create['peak_memory_kb'], create['memory_kb'])
+        self.assertGreaterEqual(result['peak_memory_kb'], create['peak_memory_kb'])
+        self.assertIsNone(result['phases']['upsert']['peak_memory_kb'])
+        self.assertEqual(Product.objects.count(), 0)
+
+    def test_status_only_for_superuser(self):
+        """Прогресс импорта доступен только суперпользователю"""
+        obj = ProductImportFile.objects.create(file=SimpleUploadedFile('products.csv', b''))
+        response = self.client.get(f'/products/import/{obj.pk}/status/')
+        self.assertEqual(response.status_code, 302)
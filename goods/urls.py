@@ -7,5 +7,6 @@ urlpatterns = [
     path('', views.IndexView.as_view(), name='main_page'),
 
     path('products/import/', views.ImportView.as_view(), name='import'),
+    path('products/import/<int:pk>/status/', views.ImportStatusView.as_view(), name='import_status'),
     path('products/reports/', views.ReportView.as_view(), name='reports')
     ]
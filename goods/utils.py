@@ -0,0 +1,65 @@
+import queue
+import threading
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    """
+    Split iterable into lists of `size` items, without reading it whole
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class Rollback(Exception):
+    """
+    Raised to roll back a transaction.atomic() block on purpose, e.g. after a benchmark
+    """
+
+
+def prefetch(iterable: Iterable, size: int = 2) -> Iterator:
+    """
+    Iterate in a background thread, keeping up to `size` items ready, so that producing
+    the next items overlaps with processing the current one. Errors are raised in the caller.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item: Tuple) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as err:
+            put((done, err))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -1,26 +1,74 @@
-from typing import Callable
+import hashlib
+from datetime import datetime
+from typing import Callable, Dict, Optional
+from urllib.parse import urlencode
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.db.models import QuerySet
-from django.http import HttpRequest
-from django.shortcuts import render, redirect
+from django.http import HttpRequest, JsonResponse
+from django.shortcuts import get_object_or_404, render, redirect
+from django.urls import reverse
+from django.utils.decorators import method_decorator
 from django.views import View
+from django.views.decorators.http import condition
 from django.views.generic import ListView
 
+from goods.cache import get_catalog_modified, get_catalog_version
 from goods.forms import ImportForm
-from goods.models import Product
-from goods.services import Import, get_products, \
-    get_report_purchases
+from goods.models import Product, ProductImportFile
+from goods.pagination import CachedCountPaginator
+from goods.services import get_products, get_report_purchases
 
 
+def index_etag(request: HttpRequest, *args, **kwargs) -> Optional[str]:
+    """
+    Pages of authenticated users show their cart, so only anonymous pages are conditional
+    """
+    if request.user.is_authenticated:
+        return None
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'{get_catalog_version()}-{path}'
+
+
+def index_last_modified(request: HttpRequest, *args, **kwargs) -> Optional[datetime]:
+    if request.user.is_authenticated:
+        return None
+    return get_catalog_modified()
+
+
+@method_decorator(condition(etag_func=index_etag, last_modified_func=index_last_modified), name='dispatch')
 class IndexView(ListView):
+    """
+    Storefront. The product grid of a page is cached per category and page,
+    the cache is dropped together with the catalog version.
+    """
     model = Product
     context_object_name = 'products'
     template_name = 'goods/index.html'
+    paginate_by = settings.INDEX_PAGE_SIZE
+
+    def get_category_params(self) -> Dict:
+        return {key: self.request.GET[key] for key in ('category_id', 'category') if self.request.GET.get(key)}
 
     def get_queryset(self) -> QuerySet:
-        return get_products()
+        params = self.get_category_params()
+        return get_products(category_id=params.get('category_id'),
+                            category_name=params.get('category')).order_by('id')
+
+    def get_paginator(self, queryset: QuerySet, per_page: int, **kwargs) -> CachedCountPaginator:
+        key = hashlib.md5(urlencode(self.get_category_params()).encode()).hexdigest()
+        return CachedCountPaginator(queryset, per_page,
+                                    count_cache_key=f'index-count:{get_catalog_version()}:{key}', **kwargs)
+
+    def get_context_data(self, **kwargs) -> Dict:
+        context = super().get_context_data(**kwargs)
+        params = self.get_category_params()
+        context['catalog_version'] = get_catalog_version()
+        context['page_query'] = urlencode(params) + '&' if params else ''
+        context['grid_cache_timeout'] = settings.CATALOG_CACHE_TIMEOUT
+        return context
 
 
 class SuperUserRequiredMixin(LoginRequiredMixin):
@@ -42,14 +90,29 @@ class ImportView(SuperUserRequiredMixin, View):
         form = self.form(request.POST, request.FILES)
         if form.is_valid():
             file = form.save()
-            imp = Import(file)
-            imp.import_data()
-            messages.add_message(request, messages.SUCCESS, 'The products was successfully added.'
-                                                            ' See the import_log file for import details.')
+            status_url = reverse('goods-polls:import_status', kwargs={'pk': file.pk})
+            messages.add_message(request, messages.SUCCESS, 'The import was queued. See products_imports '
+                                                            f'or {status_url} for its progress.')
             return redirect('admin:index')
         return redirect(request.META.get('HTTP_REFERER'))
 
 
+class ImportStatusView(SuperUserRequiredMixin, View):
+
+    def get(self, request: HttpRequest, pk: int) -> JsonResponse:
+        obj = get_object_or_404(ProductImportFile, pk=pk)
+        return JsonResponse({'file': str(obj.file),
+                             'status': obj.status,
+                             'rows_processed': obj.rows_processed,
+                             'rows_total': obj.rows_total,
+                             'dry_run': obj.dry_run,
+                             'rows_created': obj.rows_created,
+                             'rows_updated': obj.rows_updated,
+                             'rows_unchanged': obj.rows_unchanged,
+                             'errors': obj.errors,
+                             'warnings': obj.warnings})
+
+
 class ReportView(SuperUserRequiredMixin, View):
     template_name = 'admin/reports.html'
 
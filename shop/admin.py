@@ -1,11 +1,17 @@
 from django.contrib import admin
 
-from shop.models import Cart, Order, Purchase
+from shop.models import Cart, CheckoutKey, Order, Purchase, StockReservation
 
 
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user')
+    list_display = ('id', 'user', 'items_count', 'total_price')
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'cart', 'product', 'quantity', 'expires_at')
+    list_filter = ('expires_at', )
 
 
 @admin.register(Order)
@@ -13,9 +19,15 @@ class OrderAdmin(admin.ModelAdmin):
     list_display = ('id', 'fio', 'payment_method', 'phone', 'email')
 
 
+@admin.register(CheckoutKey)
+class CheckoutKeyAdmin(admin.ModelAdmin):
+    list_display = ('key', 'user', 'order', 'status_code', 'created_at')
+    list_filter = ('created_at', )
+
+
 @admin.register(Purchase)
 class PurchaseAdmin(admin.ModelAdmin):
-    list_display = ('purchase_date', 'order', 'user', 'product', 'qty')
+    list_display = ('purchase_date', 'order', 'user', 'product', 'qty', 'unit_price')
     change_list_template = 'admin/purchase_change_list.html'
     list_filter = ('purchase_date', 'user',
                    'order__id', 'product__title', 'product__category__name')
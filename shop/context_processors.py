@@ -2,23 +2,27 @@ from typing import Dict
 
 from django.conf import settings
 from django.http import HttpRequest
+from django.utils.functional import SimpleLazyObject
 
 from shop.services import UserCart
 
 
 def custom_context(request: HttpRequest) -> Dict:
+    """
+    The cart and its summary are lazy: templates which don't use them make no queries
+    """
     if request.user.is_authenticated:
-        user_cart = UserCart(request.user)
-        total = user_cart.total_sum
+        user_cart = SimpleLazyObject(lambda: UserCart(request.user))
+        summary_price = SimpleLazyObject(lambda: user_cart.total_sum[0])
+        sum_quantity = SimpleLazyObject(lambda: user_cart.total_sum[1])
     else:
-        user_cart = None
-        total = (None, None)
+        user_cart = summary_price = sum_quantity = None
     return {
         'VERIFY_TEST_MESSAGE': settings.VERIFY_TEST_MESSAGE,
         'ERROR_QUANTITY': settings.ERROR_QUANTITY,
         'SUCCESS_VERIFY': settings.SUCCESS_VERIFY,
         'ERROR_VERIFY': settings.ERROR_VERIFY,
         'cart': user_cart,
-        'summary_price': total[0],
-        'sum_quantity': total[1],
+        'summary_price': summary_price,
+        'sum_quantity': sum_quantity,
     }
@@ -4,6 +4,8 @@ from shop.models import Order
 
 
 class OrderForm(forms.ModelForm):
+    # sent again by a resubmitted form, so that the checkout is not repeated, see shop.idempotency
+    idempotency_key = forms.CharField(max_length=64, required=False, widget=forms.HiddenInput())
 
     class Meta:
         model = Order
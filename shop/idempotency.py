@@ -0,0 +1,62 @@
+"""
+Idempotency keys of checkout. A client sends the same key with every retry of one checkout,
+in the Idempotency-Key header or in the idempotency_key field of the order form. The first request
+stores its response under the key, the retries get the stored response without touching the stock
+or the purchases. Keys live CHECKOUT_KEY_TTL seconds, expired ones are deleted by purge_checkout_keys.
+"""
+from datetime import datetime, timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
+from django.utils import timezone
+
+from shop.models import CheckoutKey, Order
+
+User = get_user_model()
+
+
+def get_idempotency_key(request: HttpRequest) -> str:
+    key = request.headers.get('Idempotency-Key') or request.POST.get('idempotency_key', '')
+    return key[:CheckoutKey._meta.get_field('key').max_length]
+
+
+def get_expired_before() -> datetime:
+    return timezone.now() - timedelta(seconds=settings.CHECKOUT_KEY_TTL)
+
+
+def get_saved_response(user: User, key: str) -> Optional[HttpResponse]:
+    saved = CheckoutKey.objects.filter(user=user, key=key, created_at__gt=get_expired_before()).first()
+    if saved is None:
+        return None
+    if saved.location:
+        return HttpResponseRedirect(saved.location)
+    return HttpResponse(saved.content, status=saved.status_code)
+
+
+def save_response(user: User, key: str, response: HttpResponse, order: Optional[Order] = None) -> None:
+    """
+    Store the response under the key. Raises IntegrityError if a concurrent request with the same key
+    has stored its response first: in the checkout transaction this rolls the repeated checkout back.
+    """
+    # an expired key not purged yet is reused
+    CheckoutKey.objects.filter(user=user, key=key, created_at__lte=get_expired_before()).delete()
+    location = response.get('Location', '')
+    CheckoutKey.objects.create(user=user, key=key, order=order, status_code=response.status_code,
+                               content='' if location else response.content.decode(response.charset),
+                               location=location)
+
+
+def purge_expired(batch_size: int = 1000) -> int:
+    """
+    Delete the expired keys by batches, so that each DELETE is short
+    """
+    expired_before = get_expired_before()
+    purged = 0
+    while True:
+        batch = list(CheckoutKey.objects.filter(created_at__lte=expired_before)
+                                        .values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return purged
+        purged += CheckoutKey.objects.filter(pk__in=batch).delete()[0]
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+
+from goods.models import Product
+from shop.models import Purchase
+
+
+class Command(BaseCommand):
+    """
+    Заполняет цену и название товара в покупках, сделанных до их сохранения в покупке.
+    Берутся текущие цена и название товара, покупки обновляются пачками по возрастанию id
+    """
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--batch-size', type=int, default=1000, help='purchases updated by one query')
+
+    def handle(self, *args, **options) -> None:
+        products = Product.objects.filter(pk=OuterRef('product'))
+        last_pk, updated = 0, 0
+        while True:
+            batch = list(Purchase.objects.filter(unit_price__isnull=True, pk__gt=last_pk)
+                                         .order_by('pk')
+                                         .values_list('pk', flat=True)[:options['batch_size']])
+            if not batch:
+                break
+            updated += Purchase.objects.filter(pk__in=batch, unit_price__isnull=True)\
+                                       .update(unit_price=Subquery(products.values('price')[:1]),
+                                               title=Subquery(products.values('title')[:1]))
+            last_pk = batch[-1]
+        self.stdout.write(f'Backfilled {updated} purchases.')
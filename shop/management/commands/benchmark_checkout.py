@@ -0,0 +1,76 @@
+import threading
+from time import perf_counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, transaction
+
+from goods.exceptions import NotEnoughQuantity
+from goods.models import Category, Product
+from goods.stock import distribute_stock
+from shop.models import Order, Purchase
+from shop.services import UserCart
+
+
+class Command(BaseCommand):
+    """ Измеряет число заказов в секунду при одновременном оформлении в нескольких потоках """
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--threads', nargs='+', type=int, default=[8])
+        parser.add_argument('--shards', nargs='+', type=int, default=[0, 4],
+                            help='stock shards of the products, 0 to keep the stock in the product row')
+        parser.add_argument('--orders', type=int, default=50, help='checkouts made by each thread')
+        parser.add_argument('--products', type=int, default=2, help='products in every order')
+
+    def handle(self, *args, **options) -> None:
+        # the threads commit their own transactions, so the data can't be rolled back and is deleted instead
+        user = get_user_model().objects.create_user(email='benchmark@checkout.local', password=None,
+                                                    phone='70000000000')
+        category = Category.objects.create(name='benchmark_checkout')
+        try:
+            for threads in options['threads']:
+                for shards in options['shards']:
+                    self._benchmark(user, category, threads, shards, options['orders'], options['products'])
+        finally:
+            Order.objects.filter(email=user.email).delete()
+            category.delete()
+            user.delete()
+
+    def _benchmark(self, user, category: Category, threads: int, shards: int, orders: int, count: int) -> None:
+        products = [Product.objects.create(title=f'benchmark_{i}', article=f'bench{i}', price=10,
+                                           quantity=threads * orders, stock_shards=shards, category=category)
+                    for i in range(count)]
+        distribute_stock([product.pk for product in products])
+        results = []
+        lock = threading.Lock()
+
+        def checkout():
+            try:
+                for _ in range(orders):
+                    try:
+                        with transaction.atomic():
+                            order = Order.objects.create(fio='benchmark', phone=user.phone, email=user.email,
+                                                         city='benchmark', address='benchmark')
+                            Purchase.objects.bulk_create([Purchase(order=order, user=user, product=product, qty=1)
+                                                          for product in products])
+                            UserCart.write_off_qty(order)
+                        result = 'sold'
+                    except NotEnoughQuantity:
+                        result = 'not enough'
+                    except DatabaseError:
+                        result = 'error'
+                    with lock:
+                        results.append(result)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=checkout) for _ in range(threads)]
+        start = perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = perf_counter() - start
+        self.stdout.write(f'{threads} threads, {shards} shards: {results.count("sold") / elapsed:.0f} orders/s, '
+                          f'{results.count("not enough")} not enough quantity, {results.count("error")} errors')
+        Product.objects.filter(pk__in=[product.pk for product in products]).delete()
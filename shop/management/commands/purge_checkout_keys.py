@@ -0,0 +1,23 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from shop.idempotency import purge_expired
+
+
+class Command(BaseCommand):
+    """ Периодически удаляет истекшие ключи идемпотентности оформления заказа """
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--once', action='store_true', help='purge the expired keys once and exit')
+        parser.add_argument('--interval', type=float, default=60, help='seconds between purges')
+        parser.add_argument('--batch-size', type=int, default=1000, help='keys deleted by one query')
+
+    def handle(self, *args, **options) -> None:
+        while True:
+            purged = purge_expired(options['batch_size'])
+            if purged:
+                self.stdout.write(f'Purged {purged} expired checkout keys.')
+            if options['once']:
+                return
+            sleep(options['interval'])
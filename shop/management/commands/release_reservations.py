@@ -0,0 +1,23 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from shop.reservations import release_expired
+
+
+class Command(BaseCommand):
+    """ Периодически удаляет истекшие удержания товаров в корзинах """
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--once', action='store_true', help='release the expired holds once and exit')
+        parser.add_argument('--interval', type=float, default=60, help='seconds between releases')
+        parser.add_argument('--batch-size', type=int, default=1000, help='holds deleted by one query')
+
+    def handle(self, *args, **options) -> None:
+        while True:
+            released = release_expired(options['batch_size'])
+            if released:
+                self.stdout.write(f'Released {released} expired reservations.')
+            if options['once']:
+                return
+            sleep(options['interval'])
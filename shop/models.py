@@ -13,6 +13,10 @@ class Cart(models.Model):
     products = models.ManyToManyField(Product, through='CartProduct')
     user = models.ForeignKey(User, on_delete=models.CASCADE,
                              related_name='carts')
+    # summary of the cart products, valid while the prices version equals summary_version
+    total_price = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    items_count = models.IntegerField(default=0)
+    summary_version = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         verbose_name = 'cart'
@@ -35,6 +39,30 @@ class CartProduct(models.Model):
     def __str__(self) -> str:
         return f'{self.product} in cart'
 
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['cart', 'product'], name='cart_product_unique')]
+
+
+class StockReservation(models.Model):
+    """
+    Stock of a product held for a cart until `expires_at`, see shop.reservations
+    """
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.IntegerField()
+    expires_at = models.DateTimeField()
+
+    def __str__(self) -> str:
+        return f'{self.product} held for {self.cart} until {self.expires_at:%Y-%m-%d %H:%M}'
+
+    class Meta:
+        verbose_name = 'reservation'
+        verbose_name_plural = 'reservations'
+        db_table = 'stock_reservations'
+        constraints = [models.UniqueConstraint(fields=['cart', 'product'], name='reservation_unique')]
+        indexes = [models.Index(fields=['product', 'expires_at'], name='reservation_product_expiry'),
+                   models.Index(fields=['expires_at'], name='reservation_expiry')]
+
 
 class Order(models.Model):
     """
@@ -65,6 +93,28 @@ class Order(models.Model):
         verbose_name_plural = 'orders'
 
 
+class CheckoutKey(models.Model):
+    """
+    Response of a checkout request with an idempotency key, see shop.idempotency
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='checkout_keys')
+    key = models.CharField(max_length=64)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True)
+    status_code = models.PositiveSmallIntegerField()
+    content = models.TextField(blank=True)
+    location = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self) -> str:
+        return f'Checkout {self.key} by {self.user}'
+
+    class Meta:
+        verbose_name = 'checkout key'
+        verbose_name_plural = 'checkout keys'
+        db_table = 'checkout_keys'
+        constraints = [models.UniqueConstraint(fields=['user', 'key'], name='checkout_key_unique')]
+
+
 class Purchase(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE,
                               related_name='purchases', verbose_name='#order ')
@@ -74,6 +124,10 @@ class Purchase(models.Model):
                              related_name='buyer')
     purchase_date = models.DateField(auto_now_add=True)
     qty = models.IntegerField()
+    # the product at the time of the purchase, reports don't depend on later price changes;
+    # purchases made before these fields are filled by backfill_purchase_prices
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    title = models.CharField(max_length=100, blank=True)
 
     def __str__(self) -> str:
         return f'Purchase by {self.order} from {self.purchase_date:"%Y-%m-%d")}'
@@ -81,3 +135,6 @@ class Purchase(models.Model):
     class Meta:
         verbose_name = 'purchase'
         verbose_name_plural = 'purchases'
+        # the purchases report reads this index alone, in its order
+        indexes = [models.Index(fields=['purchase_date', 'product', 'qty', 'unit_price', 'title'],
+                                name='purchase_report')]
@@ -0,0 +1,123 @@
+"""
+Time-boxed holds of stock. Adding a product to a cart holds its quantity in the cart for
+CART_RESERVATION_TTL seconds: the stock available to the other carts is the stock minus their active holds.
+Checkout turns the holds of the cart into purchases, expired holds are deleted in bulk by release_reservations.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from goods.models import Product
+from goods.stock import stock_quantity
+from shop.models import Cart, CartProduct, StockReservation
+
+
+def get_expiry() -> datetime:
+    return timezone.now() + timedelta(seconds=settings.CART_RESERVATION_TTL)
+
+
+def held_quantity(exclude_cart_id: Optional[int] = None) -> Coalesce:
+    """
+    Expression of the quantity of a product held by active reservations, except the ones of `exclude_cart_id`
+    """
+    holds = StockReservation.objects.filter(product=OuterRef('pk'), expires_at__gt=timezone.now())
+    if exclude_cart_id is not None:
+        holds = holds.exclude(cart_id=exclude_cart_id)
+    holds = holds.values('product').annotate(total=Sum('quantity')).values('total')
+    return Coalesce(Subquery(holds, output_field=IntegerField()), 0)
+
+
+def available_quantity(exclude_cart_id: Optional[int] = None):
+    """
+    Expression of the stock of a product not held by carts other than `exclude_cart_id`
+    """
+    return stock_quantity() - held_quantity(exclude_cart_id)
+
+
+def lock_product(product_id: int) -> bool:
+    """
+    Lock the product row until the end of the transaction, False if there is no such product.
+    SQLite has no SELECT ... FOR UPDATE: a no-op UPDATE takes its write lock of the whole database instead,
+    writes are serialized there anyway.
+    """
+    if connection.features.has_select_for_update:
+        return bool(list(Product.objects.select_for_update().filter(pk=product_id).values_list('pk', flat=True)))
+    return bool(Product.objects.filter(pk=product_id).update(quantity=F('quantity')))
+
+
+def lock_for_reservation(cart_id: int, product: Product) -> bool:
+    """
+    Reservations of a product wait for each other on its row. Sharded products are sold without a lock
+    of the product row, so their reservations only wait for the other additions to the same cart:
+    concurrent carts may hold more than the stock, the write-off at checkout stays the guard.
+    """
+    if product.stock_shards and connection.features.has_select_for_update:
+        return bool(list(Cart.objects.select_for_update().filter(pk=cart_id).values_list('pk', flat=True)))
+    return lock_product(product.pk)
+
+
+def reserve(cart_id: int, product: Product, quantity: int) -> bool:
+    """
+    Hold `quantity` more of the product for the cart, if the stock not held by the other carts is enough
+    for the cart product and the addition.
+    """
+    with transaction.atomic():
+        if not lock_for_reservation(cart_id, product):
+            return False
+        in_cart = CartProduct.objects.filter(cart_id=cart_id, product_id=product.pk)\
+                                     .values_list('quantity', flat=True)\
+                                     .first() or 0
+        available = Product.objects.filter(pk=product.pk)\
+                                   .annotate(available=available_quantity(exclude_cart_id=cart_id))\
+                                   .values_list('available', flat=True)\
+                                   .first()
+        if available is None or available < in_cart + quantity:
+            return False
+        StockReservation.objects.update_or_create(cart_id=cart_id, product_id=product.pk,
+                                                  defaults={'quantity': in_cart + quantity,
+                                                            'expires_at': get_expiry()})
+    return True
+
+
+def claim_reservations(cart_id: int, quantities: Dict[int, int]) -> bool:
+    """
+    Check that the cart can buy `quantities` (product id -> quantity) and release its holds.
+    Products covered by active holds of the cart are bought without locks, the others are locked
+    (except sharded ones, see lock_for_reservation) and need enough stock not held by the other carts.
+    """
+    held = dict(StockReservation.objects.filter(cart_id=cart_id, expires_at__gt=timezone.now())
+                                        .values_list('product', 'quantity'))
+    uncovered = sorted(product_id for product_id, qty in quantities.items() if held.get(product_id, 0) < qty)
+    if not connection.features.has_select_for_update:
+        sharded = set()
+    else:
+        sharded = set(Product.objects.filter(pk__in=uncovered, stock_shards__gt=0).values_list('pk', flat=True))
+    for product_id in uncovered:
+        if product_id not in sharded and not lock_product(product_id):
+            return False
+    if uncovered:
+        available = dict(Product.objects.filter(pk__in=uncovered)
+                                        .annotate(available=available_quantity(exclude_cart_id=cart_id))
+                                        .values_list('pk', 'available'))
+        if any(available[product_id] < quantities[product_id] for product_id in uncovered):
+            return False
+    StockReservation.objects.filter(cart_id=cart_id).delete()
+    return True
+
+
+def release_expired(batch_size: int = 1000) -> int:
+    """
+    Delete the expired holds by batches, so that each DELETE is short. A hold renewed meanwhile is kept.
+    """
+    now = timezone.now()
+    released = 0
+    while True:
+        batch = list(StockReservation.objects.filter(expires_at__lte=now).values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return released
+        released += StockReservation.objects.filter(pk__in=batch, expires_at__lte=now).delete()[0]
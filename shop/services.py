@@ -2,10 +2,18 @@ from decimal import Decimal
 from typing import Tuple, List
 
 from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.db.models import Case, DecimalField, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
 
+from goods.cache import bump_catalog_version, get_prices_version
 from goods.exceptions import NotEnoughQuantity
-from goods.models import Product
+from goods.models import Product, ProductStockShard
+from goods.services import supports_upsert
+from goods.stock import stock_quantity, write_off_sharded
+from goods.utils import Rollback
 from shop.models import Cart, CartProduct, Order, Purchase
+from shop.reservations import claim_reservations, reserve
 
 User = get_user_model()
 
@@ -13,63 +21,154 @@ User = get_user_model()
 class UserCart:
 
     def __init__(self, user: User) -> None:
-        self.cart, *_ = Cart.objects.get_or_create(user=user)
+        self.cart, *_ = Cart.objects.get_or_create(user=user, defaults={'summary_version': get_prices_version()})
 
     def add_to_cart(self, product: Product, quantity: int = 1) -> bool:
-        product_in_cart = self.cart.cart_products.select_related('product').filter(product=product).first()
-        check_quantity = quantity
-        if product_in_cart:
-            check_quantity += product_in_cart.quantity
-        if self.in_stock(product, check_quantity):
-            cart_product = CartProduct.objects.filter(product=product).first()
-            if not cart_product:
-                CartProduct(product=product, cart=self.cart).save()
-            else:
-                cart_product.quantity += quantity
-                cart_product.save(update_fields=['quantity'])
-                self.cart.save()
-            return True
-        return False
+        """
+        Добавление товара в корзину, если хватает остатка, не удержанного другими корзинами.
+        Количество товара в корзине удерживается за ней на CART_RESERVATION_TTL секунд, см. shop.reservations.
+        Строка корзины записывается одним запросом с проверкой остатка, без чтения строки корзины
+        """
+        try:
+            with transaction.atomic():
+                if not reserve(self.cart.pk, product, quantity):
+                    return False
+                if supports_upsert():
+                    added = self._upsert_cart_product(product.pk, quantity)
+                else:
+                    added = self._add_cart_product_locked(product.pk, quantity)
+                if not added:
+                    # the stock of a sharded product was sold meanwhile, the hold is rolled back
+                    raise Rollback
+                Cart.objects.filter(pk=self.cart.pk).update(total_price=F('total_price') + product.price * quantity,
+                                                            items_count=F('items_count') + quantity)
+        except Rollback:
+            return False
+        self.cart.refresh_from_db(fields=['total_price', 'items_count', 'summary_version'])
+        return True
+
+    def _upsert_cart_product(self, product_id: int, quantity: int) -> bool:
+        """
+        INSERT ... ON CONFLICT DO UPDATE with the stock check in the WHERE of both branches,
+        the line is not written at all when the stock is not enough.
+        The stock is the product quantity and the quantity of its stock shards, if any
+        """
+        quote_name = connection.ops.quote_name
+        table = quote_name(CartProduct._meta.db_table)
+        products = quote_name(Product._meta.db_table)
+        shards = quote_name(ProductStockShard._meta.db_table)
+        cart_id, product, qty = [quote_name(CartProduct._meta.get_field(name).column)
+                                 for name in ('cart', 'product', 'quantity')]
+        shard_product, shard_qty = [quote_name(ProductStockShard._meta.get_field(name).column)
+                                    for name in ('product', 'quantity')]
+        pk = quote_name(Product._meta.pk.column)
+        stock = (f'{products}.{quote_name(Product._meta.get_field("quantity").column)} + '
+                 f'COALESCE((SELECT SUM({shards}.{shard_qty}) FROM {shards} '
+                 f'WHERE {shards}.{shard_product} = {products}.{pk}), 0)')
+        with connection.cursor() as cursor:
+            cursor.execute(f'INSERT INTO {table} ({cart_id}, {product}, {qty}) '
+                           f'SELECT %s, {pk}, %s FROM {products} WHERE {pk} = %s AND {stock} >= %s '
+                           f'ON CONFLICT ({cart_id}, {product}) DO UPDATE SET {qty} = {table}.{qty} + excluded.{qty} '
+                           f'WHERE (SELECT {stock} FROM {products} WHERE {products}.{pk} = excluded.{product}) '
+                           f'>= {table}.{qty} + excluded.{qty}',
+                           [self.cart.pk, quantity, product_id, quantity])
+            return cursor.rowcount == 1
+
+    def _add_cart_product_locked(self, product_id: int, quantity: int) -> bool:
+        # backends without ON CONFLICT: concurrent additions to the cart wait for the lock of its row
+        Cart.objects.select_for_update().get(pk=self.cart.pk)
+        in_cart = self.cart.cart_products.filter(product_id=product_id).values_list('quantity', flat=True).first()
+        if not Product.objects.annotate(stock=stock_quantity())\
+                              .filter(pk=product_id, stock__gte=(in_cart or 0) + quantity)\
+                              .exists():
+            return False
+        if in_cart is None:
+            CartProduct.objects.create(cart=self.cart, product_id=product_id, quantity=quantity)
+        else:
+            self.cart.cart_products.filter(product_id=product_id).update(quantity=F('quantity') + quantity)
+        return True
 
     def products_in_cart(self) -> List:
         return self.cart.cart_products.select_related('product').all()
 
     @property
     def total_sum(self) -> Tuple[Decimal, int]:
-        """Метод получения общей стоимости товаров в заказе"""
-        total = Decimal(0.00)
-        num_products = 0
-        for item in self.products_in_cart():
-            total += item.total_price
-            num_products += item.quantity
-        return Decimal(total), num_products
+        """
+        Метод получения общей стоимости и количества товаров в корзине.
+        Хранится в корзине и пересчитывается, только если с тех пор менялись цены товаров
+        """
+        version = get_prices_version()
+        if self.cart.summary_version != version:
+            self.update_summary(version)
+        return self.cart.total_price, self.cart.items_count
+
+    def update_summary(self, version: int) -> None:
+        # one UPDATE with subqueries, so that a product added meanwhile is not lost
+        cart_products = CartProduct.objects.filter(cart=OuterRef('pk')).values('cart')
+        total_price = cart_products.annotate(total=Sum(F('product__price') * F('quantity'),
+                                                           output_field=DecimalField())).values('total')
+        items_count = cart_products.annotate(count=Sum('quantity')).values('count')
+        Cart.objects.filter(pk=self.cart.pk).update(total_price=Coalesce(Subquery(total_price), Decimal(0)),
+                                                    items_count=Coalesce(Subquery(items_count), 0),
+                                                    summary_version=version)
+        self.cart.refresh_from_db(fields=['total_price', 'items_count', 'summary_version'])
 
     def clear_cart(self):
         self.cart.delete()
-        self.cart.save()
+        self.cart = Cart.objects.create(user=self.cart.user, summary_version=get_prices_version())
 
     def __len__(self):
         return len(self.cart.cart_products.all())
 
     @classmethod
     def in_stock(cls, product: Product, quantity: int) -> bool:
-        if product.quantity > 0 and product.quantity >= quantity:
+        stock = product.total_quantity
+        if stock > 0 and stock >= quantity:
             return True
         return False
 
     @classmethod
     def write_off_qty(cls, order: Order) -> None:
-        products = []
-        for item in order.purchases.all():
-            if item.product.quantity - item.qty < 0:
-               raise NotEnoughQuantity
-            item.product.quantity -= item.qty
-            products.append(item.product)
-        Product.objects.bulk_update(products, ['quantity'])
+        """
+        Списание остатков заказа одним условным UPDATE: строка товара уменьшается, только если остатка хватает.
+        Если обновлено меньше строк, чем товаров в заказе, списание отменяется.
+        Остаток товаров с шардами списывается со случайного шарда, см. goods.stock
+        """
+        quantities, sharded = {}, {}
+        for product_id, shards, qty in order.purchases.values_list('product', 'product__stock_shards')\
+                                                      .annotate(qty=Sum('qty')).order_by():
+            (sharded if shards else quantities)[product_id] = qty
+        if not quantities and not sharded:
+            return
+        with transaction.atomic():
+            if quantities:
+                write_off = Case(*[When(pk=product_id, then=Value(qty)) for product_id, qty in quantities.items()],
+                                 output_field=IntegerField())
+                updated = Product.objects.filter(pk__in=quantities, quantity__gte=write_off)\
+                                         .update(quantity=F('quantity') - write_off, import_fingerprint='')
+                if updated != len(quantities):
+                    raise NotEnoughQuantity
+            for product_id in sorted(sharded):
+                if not write_off_sharded(product_id, sharded[product_id]):
+                    raise NotEnoughQuantity
+        bump_catalog_version()
+
+    def checkout(self, order: Order) -> None:
+        """
+        Покупка товаров заказа по удержаниям корзины: товары с действующим удержанием не блокируются,
+        для остальных нужен остаток, не удержанный другими корзинами. Удержания корзины снимаются
+        """
+        quantities = dict(order.purchases.values_list('product').annotate(qty=Sum('qty')).order_by())
+        with transaction.atomic():
+            if not claim_reservations(self.cart.pk, quantities):
+                raise NotEnoughQuantity
+            self.write_off_qty(order)
 
     def add_to_purchase_history(self, order: Order) -> None:
         Purchase.objects.bulk_create([Purchase(product=item.product,
                                                user=self.cart.user,
                                                order=order,
-                                               qty=item.quantity)
+                                               qty=item.quantity,
+                                               unit_price=item.product.price,
+                                               title=item.product.title)
                                       for item in self.products_in_cart()])
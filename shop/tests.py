@@ -1,10 +1,24 @@
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from goods.models import Product, Category
-from shop.models import Order
+from goods.exceptions import NotEnoughQuantity
+from goods.models import Product, Category, ProductStockShard
+from goods.services import get_report_purchases
+from goods.stock import distribute_stock, stock_quantity
+from shop.context_processors import custom_context
+from shop.models import Cart, CartProduct, CheckoutKey, Order, Purchase, StockReservation
 from shop.services import UserCart
 
 User = get_user_model()
@@ -19,7 +33,7 @@ class ShopTestCase(TestCase):
                                             last_name='test', phone='79222222222')
         category = Category.objects.create(name='test_category')
         cls.product = Product.objects.create(title='test', article='123we', price=123,
-                                             quantity=1, category=category)
+                                             quantity=2, category=category)
         cls.perm = Permission.objects.get(codename='add_cart')
 
     def test_cart(self):
@@ -44,6 +58,10 @@ class ShopTestCase(TestCase):
         cart.add_to_cart(product)
         self.assertEqual(len(cart), 2)
 
+        # товара больше, чем на складе, в корзину не добавить
+        self.assertFalse(cart.add_to_cart(self.product))
+        self.assertEqual(CartProduct.objects.get(product=self.product).quantity, 2)
+
         # тестирование суммарной информации по корзине
         total, qty = cart.total_sum
         self.assertEqual(total, 346)
@@ -59,6 +77,18 @@ class ShopTestCase(TestCase):
         cart.add_to_purchase_history(order=order)
         cart.write_off_qty(order=order)
         self.assertEqual(product.quantity, 2)
+        product.refresh_from_db()
+        self.assertEqual(product.quantity, 1)
+
+        # при нехватке любого товара заказа не списывается ни один
+        order = Order.objects.create(fio=self.user.first_name, phone=self.user.phone, email=self.user.email,
+                                     city='testcity', address='testaddress')
+        Purchase.objects.bulk_create([Purchase(order=order, user=self.user, product=product, qty=1),
+                                      Purchase(order=order, user=self.user, product=self.product, qty=1)])
+        with self.assertRaises(NotEnoughQuantity):
+            cart.write_off_qty(order=order)
+        product.refresh_from_db()
+        self.assertEqual(product.quantity, 1)
 
         # очистка корзины
         cart.clear_cart()
@@ -77,3 +107,277 @@ class ShopTestCase(TestCase):
                                    HTTP_REFERER='http://127.0.0.1/', follow=False)
         self.assertEqual(response.status_code, 302)
 
+    def test_cart_summary(self):
+        """
+        Итог корзины хранится в ней и пересчитывается только после изменения цен
+        """
+        cache.clear()
+        product = Product.objects.create(title='test2', article='12343', price=100, quantity=5,
+                                         category=self.product.category)
+        cart = UserCart(user=self.user)
+        cart.add_to_cart(self.product)
+        cart.add_to_cart(product, quantity=2)
+        with self.assertNumQueries(0):
+            self.assertEqual(cart.total_sum, (323, 3))
+
+        # списание остатков другим заказом не сбрасывает итог
+        order = Order.objects.create(fio='test', phone=self.user.phone, email=self.user.email,
+                                     city='testcity', address='testaddress')
+        Purchase.objects.create(order=order, user=self.user, product=product, qty=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            UserCart.write_off_qty(order)
+            product.title = 'renamed'
+            product.save()
+        cart = UserCart(user=self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(cart.total_sum, (323, 3))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.price = 50
+            product.save()
+        self.assertEqual(UserCart(user=self.user).total_sum, (223, 3))
+
+        cart.clear_cart()
+        self.assertEqual(cart.total_sum, (0, 0))
+
+    def test_sharded_stock(self):
+        """
+        Остаток товара с шардами складывается из шардов, списание берет его с нескольких шардов при нехватке в одном
+        """
+        self.product.quantity, self.product.stock_shards = 7, 3
+        self.product.save()
+        distribute_stock([self.product.pk])
+        self.assertEqual(sorted(self.product.shards.values_list('quantity', flat=True)), [2, 2, 3])
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.quantity, self.product.total_quantity), (0, 7))
+
+        cart = UserCart(user=self.user)
+        self.assertTrue(cart.in_stock(self.product, 7))
+        self.assertFalse(cart.in_stock(self.product, 8))
+        self.assertTrue(cart.add_to_cart(self.product, quantity=7))
+        self.assertFalse(cart.add_to_cart(self.product))
+        cache.clear()
+        response = self.client.get(reverse('products-list'))
+        self.assertEqual([item['quantity'] for item in response.json()['results']], [7])
+
+        def buy(qty: int) -> Order:
+            order = Order.objects.create(fio=self.user.first_name, phone=self.user.phone, email=self.user.email,
+                                         city='testcity', address='testaddress')
+            Purchase.objects.create(order=order, user=self.user, product=self.product, qty=qty)
+            return order
+
+        cart.write_off_qty(buy(2))
+        # в одном шарде не больше 3 единиц, 4 списываются с нескольких без повторных попыток случайного шарда
+        order = buy(4)
+        with CaptureQueriesContext(connection) as queries:
+            cart.write_off_qty(order)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE "products_stock_shards"') and 'LIMIT 1' in query['sql']
+                             for query in queries.captured_queries), 1)
+        self.assertEqual(self.product.total_quantity, 1)
+        with self.assertRaises(NotEnoughQuantity):
+            cart.write_off_qty(buy(2))
+        self.assertEqual(self.product.total_quantity, 1)
+
+    def test_reservations(self):
+        """
+        Товар в корзине удерживается за ней до истечения срока, оформление заказа снимает удержания
+        """
+        other_user = User.objects.create_user(email='other@user.com', password='testp@sw0rd', phone='79222222223')
+        cart, other_cart = UserCart(user=self.user), UserCart(user=other_user)
+        self.assertTrue(cart.add_to_cart(self.product, quantity=2))
+        self.assertEqual(StockReservation.objects.get().quantity, 2)
+        # весь остаток удержан первой корзиной
+        self.assertFalse(other_cart.add_to_cart(self.product))
+
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(other_cart.add_to_cart(self.product))
+
+        def buy(user_cart: UserCart) -> Order:
+            order = Order.objects.create(fio='test', phone=self.user.phone, email=self.user.email,
+                                         city='testcity', address='testaddress')
+            user_cart.add_to_purchase_history(order=order)
+            return order
+
+        # удержание первой корзины истекло, а одна единица удержана второй
+        with self.assertRaises(NotEnoughQuantity):
+            cart.checkout(buy(cart))
+        other_cart.checkout(buy(other_cart))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 1)
+        self.assertFalse(other_cart.cart.reservations.exists())
+
+        out = StringIO()
+        call_command('release_reservations', '--once', stdout=out)
+        self.assertEqual(out.getvalue(), 'Released 1 expired reservations.\n')
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_idempotent_checkout(self):
+        """
+        Повтор оформления заказа с тем же ключом возвращает первый ответ, не создавая заказа и не списывая товар
+        """
+        self.client.login(email=self.user.email, password='testp@sw0rd')
+        self.user.user_permissions.add(self.perm)
+        UserCart(user=self.user).add_to_cart(self.product)
+        data = {'fio': 'user test', 'phone': self.user.phone, 'email': self.user.email, 'city': 'testcity',
+                'address': 'testaddress', 'payment_method': 'card', 'idempotency_key': 'key1'}
+        response = self.client.post(reverse('shop-polls:checkout'), data)
+        self.assertContains(response, 'Purchase was successfully done!')
+        with self.assertNumQueries(5):
+            # сессия, пользователь, права пользователя и его групп и сохраненный ответ
+            replay = self.client.post(reverse('shop-polls:checkout'), data)
+        self.assertEqual(replay.content, response.content)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(CheckoutKey.objects.get().order, Order.objects.get())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 1)
+
+        # ответ при нехватке товара тоже повторяется, ключ можно передать заголовком
+        UserCart(user=self.user).add_to_cart(self.product)
+        Product.objects.filter(pk=self.product.pk).update(quantity=0)
+        data['idempotency_key'] = ''
+        for _ in range(2):
+            response = self.client.post(reverse('shop-polls:checkout'), data, HTTP_IDEMPOTENCY_KEY='key2')
+            self.assertRedirects(response, reverse('goods-polls:main_page'), fetch_redirect_response=False)
+        self.assertEqual(Order.objects.count(), 1)
+
+        CheckoutKey.objects.filter(key='key1').update(created_at=timezone.now() - timedelta(days=2))
+        out = StringIO()
+        call_command('purge_checkout_keys', '--once', stdout=out)
+        self.assertEqual(out.getvalue(), 'Purged 1 expired checkout keys.\n')
+        self.assertEqual(list(CheckoutKey.objects.values_list('key', flat=True)), ['key2'])
+
+    def test_purchase_report(self):
+        """
+        Отчет считает выручку по ценам на момент покупки, старые покупки заполняются командой
+        """
+        cart = UserCart(user=self.user)
+        cart.add_to_cart(self.product, quantity=2)
+        order = Order.objects.create(fio=self.user.first_name, phone=self.user.phone, email=self.user.email,
+                                     city='testcity', address='testaddress')
+        cart.add_to_purchase_history(order=order)
+        self.assertEqual(Purchase.objects.values_list('unit_price', 'title').get(), (123, 'test'))
+        # покупка, сделанная до сохранения цены в покупке
+        Purchase.objects.create(order=order, user=self.user, product=self.product, qty=1)
+
+        Product.objects.filter(pk=self.product.pk).update(price=100)
+        # до заполнения покупка считается по текущей цене товара
+        with self.assertNumQueries(2):
+            result, total = get_report_purchases()
+        self.assertEqual(total, 346)
+        out = StringIO()
+        call_command('backfill_purchase_prices', '--batch-size', '1', stdout=out)
+        self.assertEqual(out.getvalue(), 'Backfilled 1 purchases.\n')
+
+        with self.assertNumQueries(1):
+            result, total = get_report_purchases()
+        day = str(timezone.now().date())
+        self.assertEqual(result, {day: {'test': {'price': Decimal('115.33'), 'quantity': 3},
+                                        'summary quantity': 3, 'summary profit': 346}})
+        self.assertEqual(total, 346)
+
+    def test_lazy_context(self):
+        """
+        Корзина не загружается, если шаблон ее не использует
+        """
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with self.assertNumQueries(0):
+            context = custom_context(request)
+        self.assertEqual(context['sum_quantity'], 0)
+        self.assertFalse(context['sum_quantity'])
+
+
+class CartConcurrencyTestCase(TransactionTestCase):
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('in-memory sqlite locks whole tables instead of waiting for them')
+
+    def _run_threads(self, target, count: int) -> None:
+        def run():
+            try:
+                target()
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent_add_to_cart(self):
+        """
+        Одновременные добавления в одну корзину не превышают остаток и не теряют количество
+        """
+        user = User.objects.create_user(email='test@user.com', password='testp@sw0rd', phone='79222222222')
+        Cart.objects.create(user=user)
+        product = Product.objects.create(title='test', article='123we', price=10, quantity=15,
+                                         category=Category.objects.create(name='test_category'))
+        results = []
+        lock = threading.Lock()
+
+        def add():
+            for _ in range(5):
+                added = UserCart(user).add_to_cart(product)
+                with lock:
+                    results.append(added)
+
+        self._run_threads(add, 8)
+        self.assertEqual(results.count(True), 15)
+        self.assertEqual(CartProduct.objects.get().quantity, 15)
+        self.assertEqual((Cart.objects.get().items_count, Cart.objects.get().total_price), (15, 150))
+
+    def test_concurrent_checkout(self):
+        """
+        Одновременные оформления заказов не продают больше остатка
+        """
+        self._concurrent_checkout(shards=0)
+
+    def test_concurrent_sharded_checkout(self):
+        """
+        Одновременные оформления заказов товаров с шардами остатка не продают больше остатка
+        """
+        self._concurrent_checkout(shards=4)
+        self.assertEqual(ProductStockShard.objects.filter(quantity__gt=0).count(), 0)
+
+    def test_benchmark_checkout(self):
+        """
+        Бенчмарк оформления заказов выдает число заказов в секунду и удаляет свои данные
+        """
+        out = StringIO()
+        call_command('benchmark_checkout', '--threads', '2', '--shards', '0', '2', '--orders', '3', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split(':')[0] for line in lines], ['2 threads, 0 shards', '2 threads, 2 shards'])
+        self.assertTrue(all('orders/s, 0 not enough quantity, 0 errors' in line for line in lines))
+        self.assertEqual((Order.objects.count(), Product.objects.count(), User.objects.count()), (0, 0, 0))
+
+    def _concurrent_checkout(self, shards: int) -> None:
+        user = User.objects.create_user(email='test@user.com', password='testp@sw0rd', phone='79222222222')
+        category = Category.objects.create(name='test_category')
+        products = [Product.objects.create(title=f'test{i}', article=f'art{i}', price=10, quantity=30,
+                                           stock_shards=shards, category=category) for i in range(2)]
+        distribute_stock([product.pk for product in products])
+        results = []
+        lock = threading.Lock()
+
+        def checkout():
+            for _ in range(10):
+                try:
+                    with transaction.atomic():
+                        order = Order.objects.create(fio='test', phone=user.phone, email=user.email,
+                                                     city='testcity', address='testaddress')
+                        Purchase.objects.bulk_create([Purchase(order=order, user=user, product=product, qty=2)
+                                                      for product in products])
+                        UserCart.write_off_qty(order)
+                    sold = True
+                except NotEnoughQuantity:
+                    sold = False
+                with lock:
+                    results.append(sold)
+
+        self._run_threads(checkout, 8)
+        self.assertEqual(results.count(True), 15)
+        self.assertEqual(list(Product.objects.annotate(stock=stock_quantity()).values_list('stock', flat=True)),
+                         [0, 0])
+        self.assertEqual(Order.objects.count(), 15)
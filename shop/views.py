@@ -1,9 +1,10 @@
 from typing import Callable
+from uuid import uuid4
 
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin, \
     PermissionRequiredMixin
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.http import HttpRequest
 from django.shortcuts import redirect, render
 from django.views import View
@@ -12,6 +13,7 @@ from django.conf import settings
 from goods.exceptions import NotEnoughQuantity
 from goods.services import get_products
 from shop.forms import OrderForm
+from shop.idempotency import get_idempotency_key, get_saved_response, save_response
 from shop.services import UserCart
 from users.services import get_user
 
@@ -59,11 +61,17 @@ class CheckoutView(VerifyMixin, View):
                    'phone': user.phone,
                    'city': user.city,
                    'address': user.address,
+                   'idempotency_key': uuid4().hex,
                    }
         form = self.form(initial=initial)
         return render(request, self.template_name, {'form': form})
 
     def post(self, request: HttpRequest) -> Callable:
+        key = get_idempotency_key(request)
+        if key:
+            saved = get_saved_response(request.user, key)
+            if saved is not None:
+                return saved
         form = self.form(request.POST)
 
         if form.is_valid():
@@ -72,13 +80,31 @@ class CheckoutView(VerifyMixin, View):
                     user_cart = UserCart(user=request.user)
                     order = form.save()
                     user_cart.add_to_purchase_history(order=order)
-                    user_cart.write_off_qty(order=order)
+                    user_cart.checkout(order=order)
                     user_cart.clear_cart()
+                    response = render(request, 'shop/success_purchase.html')
+                    if key:
+                        save_response(request.user, key, response, order)
             except NotEnoughQuantity:
                 messages.add_message(request, settings.ERROR_QUANTITY, 'Somewho was buying of some product '
                                                                        'in your cart. Purchase is impossible! '
                                                                        'Please choose again products you need buy.')
                 user_cart.clear_cart()
-                return redirect('goods-polls:main_page')
-            return render(request, 'shop/success_purchase.html')
+                response = redirect('goods-polls:main_page')
+                if key:
+                    try:
+                        save_response(request.user, key, response)
+                    except IntegrityError:
+                        saved = get_saved_response(request.user, key)
+                        if saved is None:
+                            raise
+                        return saved
+            except IntegrityError:
+                # a concurrent retry with the same key has completed the checkout, this one is rolled back,
+                # any other integrity error has no saved response and is raised
+                saved = get_saved_response(request.user, key) if key else None
+                if saved is None:
+                    raise
+                return saved
+            return response
         return render(request, self.template_name, {'form': form})